@@ -23,6 +23,19 @@ def gen_att_mask(k_lens, max_k_len, max_q_len, device=None):
     return mask
 
 
+def segment_softmax(scores, segment_ids, slot_ids, segment_num, slot_num):
+    """
+    Softmax of the scores [n, ...] within each segment, the i-th score being the
+    slot_ids[i]-th item of the segment_ids[i]-th segment. The max of each segment
+    is taken from a [segment_num, slot_num, ...] table of the scores only.
+    """
+    table = scores.new_full((segment_num, slot_num) + scores.size()[1:], -np.inf)
+    table[segment_ids, slot_ids] = scores.detach()
+    exp_scores = (scores - table.max(1)[0][segment_ids]).exp()
+    sums = exp_scores.new_zeros((segment_num,) + scores.size()[1:]).index_add(0, segment_ids, exp_scores)
+    return exp_scores / sums[segment_ids]
+
+
 class MultiHeadAttention(nn.Module):
     """ Multi-Head Attention module """
 
@@ -91,6 +104,35 @@ class MultiHeadAttention(nn.Module):
 
         return output, attn
 
+    def forward_ragged(self, q, k, v, segment_ids, slot_ids, slot_num, memory_ids=None):
+        """
+            Each query q[i] attends to the keys/values of segment i only:
+                q:            [num_q, d_q]
+                k/v:          [num_k, d_k/d_v], flat over the segments
+                segment_ids:  [num_k], the query of each key
+                slot_ids:     [num_k], the position of each key in its segment, < slot_num
+                memory_ids:   [num_k], if given, k/v are the distinct keys/values and
+                              the i-th key is k[memory_ids[i]], projected only once
+            Return the [num_q, d_out] outputs and the [num_k, n_head] attention weights,
+            the same as forward with the keys of each query padded to slot_num and masked.
+        """
+        d_att_k, d_att_v, n_head = self.d_att_k, self.d_att_v, self.n_head
+        len_q = q.size(0)
+
+        q = self.w_qs(q).view(len_q, n_head, d_att_k)
+        k = self.w_ks(k).view(-1, n_head, d_att_k)
+        v = self.w_vs(v).view(-1, n_head, d_att_v)
+        if memory_ids is not None:
+            k, v = k[memory_ids], v[memory_ids]
+
+        attn = (q[segment_ids] * k).sum(2) / self.attention.temperature
+        attn = segment_softmax(attn, segment_ids, slot_ids, len_q, slot_num)
+        attn = self.attention.dropout(attn)
+        output = v.new_zeros(len_q, n_head, d_att_v).index_add(0, segment_ids, attn.unsqueeze(2) * v)
+
+        output = self.dropout(self.fc(output.view(len_q, -1)))
+        return output, attn
+
 
 class PositionWiseFeedForward(nn.Module):
     """ A two-feed-forward-layer module """
@@ -158,3 +200,20 @@ class VanillaAttention(nn.Module):
         output, attn = self.attention(query, memory, memory, mask=mask)
         output = self.dropout(output)
         return output, attn
+
+    def forward_ragged(self, query, memory, segment_ids, slot_ids, slot_num, memory_ids=None):
+        """
+            The query [num_q, query_size] attends to its segment of the flat memory
+            [num_mem, mem_size], see MultiHeadAttention.forward_ragged.
+            Return the [num_q, mem_size] outputs and the [num_mem] attention weights.
+        """
+        query = self.aff_query(query)
+        if memory_ids is not None:
+            memory = memory[memory_ids]
+        attn = (query[segment_ids] * memory).sum(1) / self.attention.temperature
+        attn = segment_softmax(attn, segment_ids, slot_ids, query.size(0), slot_num)
+        attn = self.attention.dropout(attn)
+        output = memory.new_zeros(query.size(0), memory.size(1)).index_add(0, segment_ids,
+                                                                           attn.unsqueeze(1) * memory)
+        output = self.dropout(output)
+        return output, attn
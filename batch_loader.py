@@ -0,0 +1,142 @@
+from typing import NamedTuple, List
+import queue
+import threading
+import numpy as np
+import torch
+from dataset import Sp, Datum, max_match_num
+
+Batch = NamedTuple("Batch", [("data", List[Datum]),
+                             ("text_lens", List[int]),
+                             ("chars", torch.Tensor),
+                             ("bichars", torch.Tensor),
+                             ("segs", torch.Tensor),
+                             ("poss", torch.Tensor),
+                             ("ners", torch.Tensor),
+                             ("text_masks", torch.Tensor),
+                             ("match_lexicons", torch.Tensor),
+                             ("match_types", torch.Tensor),
+                             ("match_memory_ids", torch.Tensor),
+                             ("match_frag_ids", torch.Tensor),
+                             ("match_slot_ids", torch.Tensor),
+                             ("span_ys", torch.Tensor)])
+
+
+def batch_to(batch: Batch, device) -> Batch:
+    return batch._replace(**{
+        field: getattr(batch, field).to(device, non_blocking=True)
+        for field in Batch._fields
+        if isinstance(getattr(batch, field), torch.Tensor)
+    })
+
+
+def pad_tensor(seqs, pad_ele, pad_len) -> torch.Tensor:
+    arr = np.full((len(seqs), pad_len), pad_ele, dtype=np.int64)
+    for i, seq in enumerate(seqs):
+        arr[i, :len(seq)] = seq
+    return torch.from_numpy(arr)
+
+
+class BatchBuilder:
+    """
+    Turn a list of Datum into a Batch of padded LongTensors, sorted by the
+    text length in descending order.
+    """
+
+    def __init__(self, char2idx, bichar2idx, seg2idx, pos2idx):
+        self.char_pad = char2idx[Sp.pad]
+        self.bichar_pad = bichar2idx[Sp.pad]
+        self.seg_pad = seg2idx[Sp.pad]
+        self.pos_pad = pos2idx[Sp.pad]
+
+    def __call__(self, batch_data: List[Datum]) -> Batch:
+        batch_data = sorted(batch_data, key=lambda x: len(x.chars), reverse=True)
+        text_lens = [len(datum.chars) for datum in batch_data]
+        max_len = text_lens[0]
+
+        text_masks = torch.arange(max_len).unsqueeze(0) < torch.tensor(text_lens).unsqueeze(1)
+
+        span_ys = torch.from_numpy(np.concatenate([datum.span_ys for datum in batch_data])).long()
+
+        if batch_data[0].lexmatches is not None:
+            # the matches of all fragments as a flat list, the j-th match of the i-th fragment
+            # at (match_frag_ids, match_slot_ids) = (i, j); match_lexicons/match_types hold each
+            # (lexicon, type) pair of the batch once, match_memory_ids the pair of each match
+            frag_lexicons = np.concatenate([x.lexmatches.lexicons for x in batch_data])
+            frag_types = np.concatenate([x.lexmatches.types for x in batch_data])
+            match_nums = np.concatenate([x.lexmatches.nums for x in batch_data])
+            matched = np.arange(max_match_num)[None, :] < match_nums[:, None]
+            match_frag_ids, match_slot_ids = np.nonzero(matched)
+            type_num = int(frag_types.max()) + 1
+            pairs = frag_lexicons[matched].astype(np.int64) * type_num + frag_types[matched]
+            pairs, match_memory_ids = np.unique(pairs, return_inverse=True)
+            match_lexicons = torch.from_numpy(pairs // type_num)
+            match_types = torch.from_numpy(pairs % type_num)
+            match_memory_ids = torch.from_numpy(match_memory_ids.reshape(-1)).long()
+            match_frag_ids = torch.from_numpy(match_frag_ids).long()
+            match_slot_ids = torch.from_numpy(match_slot_ids).long()
+        else:
+            match_lexicons, match_types, match_memory_ids, match_frag_ids, match_slot_ids = [None] * 5
+
+        return Batch(data=batch_data,
+                     text_lens=text_lens,
+                     chars=pad_tensor([x.chars for x in batch_data], self.char_pad, max_len),
+                     bichars=pad_tensor([x.bichars for x in batch_data], self.bichar_pad, max_len),
+                     segs=pad_tensor([x.segs for x in batch_data], self.seg_pad, max_len),
+                     poss=pad_tensor([x.poss for x in batch_data], self.pos_pad, max_len),
+                     ners=pad_tensor([x.ners for x in batch_data], 0, max_len),
+                     text_masks=text_masks.byte(),
+                     match_lexicons=match_lexicons,
+                     match_types=match_types,
+                     match_memory_ids=match_memory_ids,
+                     match_frag_ids=match_frag_ids,
+                     match_slot_ids=match_slot_ids,
+                     span_ys=span_ys)
+
+
+def prefetch_batches(data_set, next_batch, build_batch, depth=0):
+    """
+    Yield build_batch(next_batch()) until data_set is finished. With depth > 0
+    the batches are built on a background thread, at most depth batches ahead,
+    so that the padding and tensor creation overlap with the model.
+    The data_set must not be used by the caller until the generator is done.
+    """
+    if depth <= 0:
+        while not data_set.finished:
+            yield build_batch(next_batch())
+        return
+
+    ready = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            while not data_set.finished:
+                if not put(build_batch(next_batch())):
+                    return
+            put(done)
+        except BaseException as e:
+            put(e)
+
+    worker = threading.Thread(target=produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = ready.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        worker.join()
@@ -0,0 +1,53 @@
+"""
+Time the sequential and the parallel scan CRF (normalizer forward + backward, and
+Viterbi decoding) on the sentence lengths of a data set:
+    python bench_crf.py --use_data_set msra
+Emission scores are random, for the tags of the data set.
+"""
+import time
+import torch
+from dataset import usable_data_sets, load_sentences
+from torch_crf import CRF
+from program_args import config
+
+
+def gen_batches(lengths, num_tags, device):
+    for i in range(0, len(lengths), config.batch_size):
+        batch_lens = sorted(lengths[i: i + config.batch_size], reverse=True)
+        emissions = torch.randn(len(batch_lens), batch_lens[0], num_tags, device=device, requires_grad=True)
+        masks = torch.arange(batch_lens[0], device=device).unsqueeze(0) < \
+            torch.tensor(batch_lens, device=device).unsqueeze(1)
+        tags = torch.randint(num_tags, (len(batch_lens), batch_lens[0]), device=device)
+        yield emissions, tags, masks.byte()
+
+
+def bench(crf, batches, device):
+    start = time.time()
+    for emissions, tags, masks in batches:
+        crf(emissions, tags, masks).backward()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    train_cost = time.time() - start
+    start = time.time()
+    with torch.no_grad():
+        for emissions, tags, masks in batches:
+            crf.decode(emissions, masks)
+    return train_cost, time.time() - start
+
+
+def main():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    sentences = load_sentences(usable_data_sets[config.use_data_set][0])
+    sentences = [sen for sen in sentences if len(sen) < config.max_sentence_length]
+    num_tags = len({line[-1] for sen in sentences for line in sen})
+    batches = list(gen_batches([len(sen) for sen in sentences], num_tags, device))
+    print("{} sentences, {} batches, {} tags, device {}".format(len(sentences), len(batches), num_tags, device))
+    for parallel_scan in [False, True]:
+        crf = CRF(num_tags, batch_first=True, parallel_scan=parallel_scan).to(device)
+        train_cost, decode_cost = bench(crf, batches, device)
+        print("{:>10}: normalizer {:.2f} seconds, viterbi {:.2f} seconds".format(
+            "scan" if parallel_scan else "sequential", train_cost, decode_cost))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Time the fragment encoders (forward + backward) on the sentence lengths of a data set:
+    python bench_frag.py --use_data_set ontogold --max_span_length 15
+Token representations are random, of size config.rnn_hidden.
+"""
+import time
+import torch
+from dataset import usable_data_sets, load_sentences
+from frag_enumerator import FragmentEnumerator, BoundaryEnumerator
+from seq_encoder import RNNSeqEncoder, FofeSeqEncoder
+from program_args import config
+
+
+def gen_encoders(token_dim):
+    S = config.max_span_length
+    return {
+        "rnn": FragmentEnumerator(S, RNNSeqEncoder, ('lstm', token_dim, token_dim), fusion=config.frag_fusion),
+        "fofe": FragmentEnumerator(S, FofeSeqEncoder, (config.frag_fofe_alpha,), fusion=config.frag_fusion),
+        "boundary": BoundaryEnumerator(S, token_dim, config.frag_width_emb_size, fusion=config.frag_fusion),
+    }
+
+
+def bench(encoder, batches, token_dim, device):
+    sos = torch.randn(token_dim, device=device) if config.frag_use_sos == "on" else None
+    start = time.time()
+    frag_num = 0
+    for lengths in batches:
+        inputs = torch.randn(len(lengths), max(lengths), token_dim, device=device, requires_grad=True)
+        fragments = encoder(inputs, lengths, sos_repr=sos, eos_repr=sos)
+        fragments.sum().backward()
+        frag_num += fragments.size(0)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return time.time() - start, frag_num
+
+
+def main():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    sentences = load_sentences(usable_data_sets[config.use_data_set][0])
+    lengths = [len(sen) for sen in sentences if len(sen) < config.max_sentence_length]
+    batches = [sorted(lengths[i: i + config.batch_size], reverse=True)
+               for i in range(0, len(lengths), config.batch_size)]
+    token_dim = config.rnn_hidden
+    print("{} sentences, {} batches, max_span_length {}, device {}".format(
+        len(lengths), len(batches), config.max_span_length, device))
+    for name, encoder in gen_encoders(token_dim).items():
+        encoder.to(device)
+        cost, frag_num = bench(encoder, batches, token_dim, device)
+        print("{:>10}: {:.2f} seconds, {:.0f} fragments/second".format(name, cost, frag_num / cost))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,8 @@ import numpy as np
 import re
 import pickle
 import random
+import json
+import hashlib
 import argparse
 from typing import List, Dict, NamedTuple, Union
 from colorama import Fore, Back
@@ -13,6 +15,7 @@ import psutil
 from sklearn.metrics import precision_recall_fscore_support as sklearn_prf
 
 __saved_path__ = "saved/vars"
+__array_cache_version__ = 3
 
 arg_required = object()
 arg_optional = object()
@@ -56,18 +59,124 @@ def exist_var(name, path=None):
     return os.path.exists("{}/{}.pkl".format(path, name))
 
 
-def auto_create(name, func, cache=False, path=None):
+def file_fingerprint(*file_paths, **extra):
+    """
+    Hash of the paths, sizes and modification times of the files together with
+    the extra key-value pairs.
+    """
+    sha = hashlib.sha1()
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        sha.update("{}:{}:{};".format(file_path, stat.st_size, stat.st_mtime_ns).encode("utf8"))
+    for key in sorted(extra):
+        sha.update("{}={};".format(key, extra[key]).encode("utf8"))
+    return sha.hexdigest()
+
+
+def cache_key(name, *file_paths, **extra):
+    """
+    Name of a cached artifact, suffixed with the fingerprint of what it is built from.
+    """
+    return "{}.{}".format(name, file_fingerprint(*file_paths, **extra)[:16])
+
+
+def save_arrays(arrays: Dict[str, np.ndarray], meta: dict, name, path=None, fingerprint=None):
+    """
+    Save numpy arrays as {path}/{name}/{key}.npy plus a header.json recording
+    the cache version, the fingerprint, the meta info and the array shapes.
+    The header is written last, so an interrupted save is never loaded.
+    """
     if path is None:
         path = __saved_path__
-    if cache and exist_var(name, path):
+    folder = "{}/{}".format(path, name)
+    create_folder(folder)
+    header_path = "{}/header.json".format(folder)
+    if os.path.exists(header_path):
+        os.remove(header_path)
+    for key, value in arrays.items():
+        np.save("{}/{}.npy".format(folder, key), value)
+    save_array_header(arrays, meta, name, path, fingerprint)
+
+
+def save_array_header(arrays: Dict[str, np.ndarray], meta: dict, name, path=None, fingerprint=None):
+    """
+    Write the header.json of arrays already saved as {path}/{name}/{key}.npy,
+    for arrays written in place with np.lib.format.open_memmap.
+    """
+    if path is None:
+        path = __saved_path__
+    header_path = "{}/{}/header.json".format(path, name)
+    header = {"version": __array_cache_version__,
+              "fingerprint": fingerprint,
+              "meta": meta,
+              "arrays": {key: [str(value.dtype), list(value.shape)] for key, value in arrays.items()}}
+    json.dump(header, open(header_path + ".tmp", "w"))
+    os.replace(header_path + ".tmp", header_path)
+
+
+def exist_arrays(name, path=None, fingerprint=None):
+    """
+    Whether a saved array cache exists with the current version and the same fingerprint.
+    """
+    if path is None:
+        path = __saved_path__
+    header_path = "{}/{}/header.json".format(path, name)
+    if not os.path.exists(header_path):
+        return False
+    header = json.load(open(header_path))
+    if header["version"] != __array_cache_version__:
+        print("cache for {} has version {}, expect {}".format(name, header["version"], __array_cache_version__))
+        return False
+    if header["fingerprint"] != fingerprint:
+        print("cache for {} is stale".format(name))
+        return False
+    return True
+
+
+def load_arrays(name, path=None, mmap_mode='r') -> (Dict[str, np.ndarray], dict):
+    """
+    Open the arrays saved by save_arrays, memory-mapped by default.
+    """
+    if path is None:
+        path = __saved_path__
+    folder = "{}/{}".format(path, name)
+    header = json.load(open("{}/header.json".format(folder)))
+    arrays = {}
+    for key, (dtype, shape) in header["arrays"].items():
+        arrays[key] = np.load("{}/{}.npy".format(folder, key), mmap_mode=mmap_mode)
+        if str(arrays[key].dtype) != dtype or list(arrays[key].shape) != shape:
+            raise Exception("array {} of cache {} is broken".format(key, name))
+    return arrays, header["meta"]
+
+
+def auto_create(name, func, cache=False, path=None, fingerprint=None, array_cls=None):
+    """
+    Create an object with func and cache it under path. If array_cls is given, the
+    object is cached with save_arrays(*obj.to_arrays()) and restored with
+    array_cls.from_arrays(*load_arrays()), a cache with a different fingerprint
+    is rebuilt. Otherwise the object is pickled.
+    """
+    if path is None:
+        path = __saved_path__
+    if array_cls is not None:
+        exist = exist_arrays(name, path, fingerprint)
+    else:
+        exist = exist_var(name, path)
+    if cache and exist:
         print("cache for {} exists".format(name))
         with time_record("*** load {} from cache".format(name)):
-            obj = load_var(name, path)
+            if array_cls is not None:
+                obj = array_cls.from_arrays(*load_arrays(name, path))
+            else:
+                obj = load_var(name, path)
     else:
         print("cache for {} does not exist".format(name))
         with time_record("*** create {} and save to cache".format(name)):
             obj = func()
-            save_var(obj, name, path)
+            if array_cls is not None:
+                save_arrays(*obj.to_arrays(), name, path, fingerprint)
+            else:
+                save_var(obj, name, path)
     return obj
 
 
@@ -116,6 +225,19 @@ class ProgressManager:
         return self.__total
 
 
+def budget_end(costs, start, budget):
+    """
+    End (exclusive) of the items taken from start while their summed cost is
+    within budget, at least one item.
+    """
+    end = start + 1
+    total = costs[start]
+    while end < len(costs) and total + costs[end] <= budget:
+        total += costs[end]
+        end += 1
+    return end
+
+
 class DataSet:
     def __init__(self):
         self.data = []
@@ -133,6 +255,16 @@ class DataSet:
             self.__next += batch_size
         return ret
 
+    def next_batch_by_budget(self, budget, costs):
+        """
+        Take the next items while their summed cost is within budget, at least
+        one item. costs[i] is the cost of self.data[i].
+        """
+        end = budget_end(costs, self.__next, budget)
+        ret = self.data[self.__next:end]
+        self.__next = end
+        return ret
+
     @property
     def size(self):
         return len(self.data)
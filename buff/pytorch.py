@@ -1,4 +1,6 @@
 from .public import *
+from . import public
+import multiprocessing
 import torch
 from torch.nn.utils.rnn import PackedSequence
 import torch.nn.functional as F
@@ -112,40 +114,219 @@ def var2num(x):
     return x.cpu().data[0]
 
 
+def parse_word2vec_lines(text, emb_size, vocab=None, with_vectors=True) -> (List[str], np.ndarray, int):
+    """
+    Parse the lines of a .vec file chunk. Lines whose number of fields is not
+    emb_size + 1 (or less than 10) are errors, lines whose word is not in vocab
+    are skipped. Return the words, their vectors as a float32 matrix (None if
+    not with_vectors) and the number of error lines.
+    """
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    words, values = [], []
+    error_num = 0
+    for line in lines:
+        split = line.split()
+        if len(split) != emb_size + 1 or len(split) < 10:
+            error_num += 1
+            continue
+        if vocab is not None and split[0] not in vocab:
+            continue
+        words.append(split[0])
+        if with_vectors:
+            values.append(split[1:])
+    if with_vectors:
+        vectors = np.array(values, dtype=np.float32).reshape(len(words), emb_size)
+    else:
+        vectors = None
+    return words, vectors, error_num
+
+
+__parser_args__ = None
+
+
+def _init_parse_worker(emb_size, vocab, with_vectors):
+    global __parser_args__
+    __parser_args__ = (emb_size, vocab, with_vectors)
+
+
+def _parse_chunk(chunk):
+    return parse_word2vec_lines(chunk.decode("utf8", errors="ignore"), *__parser_args__)
+
+
+def _iter_line_chunks(binary_file, chunk_bytes):
+    # chunks of about chunk_bytes, each cut after a "\n" so no line is split
+    rest = b""
+    while True:
+        chunk = binary_file.read(chunk_bytes)
+        if chunk == b"":
+            break
+        chunk = rest + chunk
+        cut = chunk.rfind(b"\n") + 1
+        rest = chunk[cut:]
+        if cut > 0:
+            yield chunk[:cut]
+    if rest != b"":
+        yield rest
+
+
+def read_word2vec_words(word2vec_path, chunk_bytes=1 << 24):
+    """
+    Stream the first token of every line of a .vec file (the header line and
+    malformed lines included), without parsing the vectors.
+    """
+    with open(word2vec_path, "rb") as word2vec_file:
+        for chunk in _iter_line_chunks(word2vec_file, chunk_bytes):
+            for line in chunk.decode("utf8", errors="ignore").split("\n"):
+                split = line.split(None, 1)
+                if split:
+                    yield split[0]
+
+
+def read_word2vec(word2vec_path, vocab=None, with_vectors=True,
+                  chunk_bytes=1 << 24, num_workers=0):
+    """
+    Stream a .vec file in chunks of about chunk_bytes, yielding the
+    (words, vectors, error_num) of parse_word2vec_lines for each chunk, so only
+    the kept rows are held in memory. The embedding size is decided by the first
+    line. With num_workers > 0 the chunks are parsed on a process pool.
+    """
+    with open(word2vec_path, "rb") as word2vec_file:
+        first_line = word2vec_file.readline().decode("utf8", errors="ignore")
+        emb_size = len(first_line.split()) - 1
+        word2vec_file.seek(0)
+        chunks = _iter_line_chunks(word2vec_file, chunk_bytes)
+
+        if num_workers > 0:
+            with multiprocessing.Pool(num_workers,
+                                      initializer=_init_parse_worker,
+                                      initargs=(emb_size, vocab, with_vectors)) as pool:
+                for parsed in pool.imap(_parse_chunk, chunks):
+                    yield parsed
+        else:
+            for chunk in chunks:
+                yield parse_word2vec_lines(chunk.decode("utf8", errors="ignore"),
+                                           emb_size, vocab, with_vectors)
+
+
+def convert_word2vec(word2vec_path, path=None, num_workers=0):
+    """
+    Convert a .vec file once into a float32 matrix ({name}/matrix.npy) and the
+    word of each row ({name}/words.txt), where name is the cache key of the file.
+    Returns the name to open it with load_word2vec_store.
+    """
+    if path is None:
+        path = public.__saved_path__
+    name = cache_key("word2vec", word2vec_path)
+    if exist_arrays(name, path, fingerprint=name):
+        return name
+    log("Convert word2vec {} to {}/{}".format(word2vec_path, path, name))
+    folder = "{}/{}".format(path, name)
+    create_folder(folder)
+
+    # the first pass only counts the rows to allocate the matrix
+    row_num, emb_size, error_num = 0, 0, 0
+    for words, _, chunk_error_num in read_word2vec(word2vec_path, with_vectors=False,
+                                                   num_workers=num_workers):
+        row_num += len(words)
+        error_num += chunk_error_num
+    matrix = None
+    row = 0
+    with open("{}/words.txt".format(folder), "w", encoding="utf8") as words_file:
+        for words, vectors, _ in read_word2vec(word2vec_path, num_workers=num_workers):
+            if matrix is None:
+                emb_size = vectors.shape[1]
+                matrix = np.lib.format.open_memmap("{}/matrix.npy".format(folder), mode="w+",
+                                                   dtype=np.float32, shape=(row_num, emb_size))
+            for word in words:
+                words_file.write(word + "\n")
+            matrix[row: row + len(words)] = vectors
+            row += len(words)
+    if matrix is None:
+        matrix = np.lib.format.open_memmap("{}/matrix.npy".format(folder), mode="w+",
+                                           dtype=np.float32, shape=(0, 0))
+    matrix.flush()
+    save_array_header({"matrix": matrix}, {"error_num": error_num}, name, path, fingerprint=name)
+    return name
+
+
+def load_word2vec_store(name, path=None) -> (np.ndarray, Dict[str, int], Dict[str, int], int):
+    """
+    Open a store written by convert_word2vec, return the memory-mapped matrix,
+    the word -> row index, the word -> number of rows of the duplicated words
+    and the number of error lines.
+    """
+    if path is None:
+        path = public.__saved_path__
+    arrays, meta = load_arrays(name, path)
+    word2row = {}
+    duplicates = {}
+    for row, word in enumerate(open("{}/{}/words.txt".format(path, name), encoding="utf8")):
+        word = word.rstrip("\n")
+        if word in word2row:
+            duplicates[word] = duplicates.get(word, 1) + 1
+        # later rows of a duplicated word win, as in the text format
+        word2row[word] = row
+    return arrays["matrix"], word2row, duplicates, meta["error_num"]
+
+
 def load_word2vec(embedding: torch.nn.Embedding,
                   word_dict: Dict[str, int],
                   word2vec_path,
                   norm=True,
-                  cached_name=None):
-    cache = "{}{}".format(cached_name, ".norm" if norm else "")
+                  cached_name=None,
+                  use_store=False,
+                  num_workers=0):
+    """
+    use_store: gather the rows from the binary store of convert_word2vec,
+               otherwise stream the text file keeping only the rows of word_dict.
+    num_workers: processes parsing the chunks of the text file, see read_word2vec.
+    Words not in the file are initialized from N(0, 1). The match case counts
+    every line of a word in word_dict, duplicated words as often as they occur.
+    """
+    if cached_name:
+        cache = cache_key(cached_name, word2vec_path,
+                          norm=norm,
+                          size=tuple(embedding.weight.size()),
+                          word_dict=sorted(word_dict.items()))
     if cached_name and exist_var(cache):
         log("Load word2vec from cache {}".format(cache))
         pre_embedding = load_var(cache)
     else:
         log("Load word2vec from {}".format(word2vec_path))
-        pre_embedding = np.random.normal(0, 1, embedding.weight.size())
-        word2vec_file = open(word2vec_path, errors='ignore')
-        # x = 0
-        found = 0
-        emb_size = -1
-        error_num = 0
-        for line in word2vec_file.readlines():
-            # x += 1
-            # log("Process line {} in file {}".format(x, word2vec_path))
-            split = re.split(r"\s+", line.strip())
-            if emb_size == -1:
-                emb_size = len(split) - 1
-            if len(split) != emb_size + 1 or len(split) < 10:
-                error_num += 1
-                continue
-            word = split[0]
-            if word in word_dict:
-                found += 1
-                pre_embedding[word_dict[word]] = np.array(list(map(float, split[1:])))
+        pre_embedding = np.empty(tuple(embedding.weight.size()), dtype=np.float32)
+        matched = np.zeros(pre_embedding.shape[0], dtype=bool)
+        if use_store:
+            matrix, word2row, duplicates, error_num = load_word2vec_store(
+                convert_word2vec(word2vec_path, num_workers=num_workers))
+            found_ids, found_rows = [], []
+            found = 0
+            for word, idx in word_dict.items():
+                if word in word2row:
+                    found_ids.append(idx)
+                    found_rows.append(word2row[word])
+                    found += duplicates.get(word, 1)
+            # gather only the rows of the vocab, in file order to read the memory map sequentially
+            order = np.argsort(found_rows)
+            found_ids = np.array(found_ids, dtype=np.int64)[order]
+            pre_embedding[found_ids] = matrix[np.array(found_rows, dtype=np.int64)[order]]
+            matched[found_ids] = True
+        else:
+            found = 0
+            error_num = 0
+            for words, vectors, chunk_error_num in read_word2vec(word2vec_path, vocab=word_dict,
+                                                                 num_workers=num_workers):
+                found += len(words)
+                error_num += chunk_error_num
+                found_ids = [word_dict[word] for word in words]
+                pre_embedding[found_ids] = vectors
+                matched[found_ids] = True
+        pre_embedding[~matched] = np.random.normal(0, 1, (int((~matched).sum()), pre_embedding.shape[1]))
         log("Error line: ", error_num)
         log("Pre_train match case: {:.4f}".format(found / len(word_dict)))
         if norm:
-            pre_embedding = pre_embedding / np.std(pre_embedding)
+            pre_embedding /= np.std(pre_embedding, dtype=np.float64)
         if cached_name:
             save_var(pre_embedding, cache)
     embedding.weight.data.copy_(torch.from_numpy(pre_embedding))
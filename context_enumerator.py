@@ -1,7 +1,7 @@
 import torch
 from seq_encoder import BaseSeqEncoder
 from buff import flip_by_length
-from enum_index import gen_inc_context_ids, gen_exc_context_ids
+from enum_index import inc_context_id_tensors, exc_context_id_tensors
 
 
 class ContextEnumerator(torch.nn.Module):
@@ -31,15 +31,10 @@ class ContextEnumerator(torch.nn.Module):
         e2b_outputs = e2b_outputs.contiguous().view(-1, e2b_outputs.size(2))
 
         if self.include:
-            b2e_ids, e2b_ids = gen_inc_context_ids(lengths, self.max_span_len)
-            left_contexts = b2e_outputs.index_select(0, torch.tensor(b2e_ids, device=inputs.device))
-            right_contexts = e2b_outputs.index_select(0, torch.tensor(e2b_ids, device=inputs.device))
+            b2e_ids, e2b_ids = inc_context_id_tensors(tuple(lengths), self.max_span_len, inputs.device)
         else:
-            b2e_ids, e2b_ids = gen_exc_context_ids(lengths, self.max_span_len)
-
-            pad_index = b2e_outputs.size(0)
-            b2e_ids = [ele if ele != -1 else pad_index for ele in b2e_ids]
-            e2b_ids = [ele if ele != -1 else pad_index for ele in e2b_ids]
+            # the ids of -1 point to the start tensors appended after the outputs
+            b2e_ids, e2b_ids = exc_context_id_tensors(tuple(lengths), self.max_span_len, inputs.device)
 
             b2e_outputs = torch.cat([b2e_outputs, self.b_start_tensor], dim=0)
             e2b_outputs = torch.cat([e2b_outputs, self.e_start_tensor], dim=0)
@@ -47,7 +42,7 @@ class ContextEnumerator(torch.nn.Module):
             # print(self.b_start_tensor[0][:10])
             # print(b2e_outputs[0][:10])
 
-            left_contexts = b2e_outputs.index_select(0, torch.tensor(b2e_ids, device=inputs.device))
-            right_contexts = e2b_outputs.index_select(0, torch.tensor(e2b_ids, device=inputs.device))
+        left_contexts = b2e_outputs.index_select(0, b2e_ids)
+        right_contexts = e2b_outputs.index_select(0, e2b_ids)
 
         return left_contexts, right_contexts
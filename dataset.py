@@ -4,8 +4,11 @@ import re
 import math
 from collections import defaultdict
 from functools import lru_cache
-from buff import exist_var, load_var, save_var
+from buff import exist_var, load_var, save_var, read_word2vec_words, budget_end
 import os
+import array
+import random
+import multiprocessing
 from program_args import config
 import numpy as np
 
@@ -33,18 +36,20 @@ usable_data_sets = {
              "dataset/ontonotes4/tiny.mix.bmes")}
 
 
-def load_sentences(file_path, sep=r"\s+"):
-    ret = []
+def iter_sentences(file_path, sep=r"\s+"):
     sentence = []
     for line in open(file_path, encoding='utf8'):
         line = line.strip("\n")
         if line == "":
             if not sentence == []:
-                ret.append(sentence)
+                yield sentence
                 sentence = []
         else:
             sentence.append(re.split(sep, line))
-    return ret
+
+
+def load_sentences(file_path, sep=r"\s+"):
+    return list(iter_sentences(file_path, sep))
 
 
 def pair(a, b):
@@ -66,7 +71,8 @@ Datum = NamedTuple("Datum", [("chars", List[int]),
                              ("poss", List[int]),
                              ("ners", List[int]),
                              ("lexmatches", object),
-                             ("labels", List[SpanLabel])])
+                             ("labels", List[SpanLabel]),
+                             ("span_ys", np.ndarray)])
 
 
 class Sp:
@@ -199,6 +205,256 @@ match2idx_mix = {
 idx2match_mix = {v: k for k, v in match2idx_mix.items()}
 
 
+class SentenceEncoder:
+    """
+    Encode one sentence of the mixed BMES file into a Datum. It holds everything
+    a worker of the parallel ConllDataSet construction needs.
+    """
+
+    def __init__(self,
+                 lexicon2idx,
+                 char2idx, bichar2idx, seg2idx, pos2idx, ner2idx, label2idx,
+                 ignore_pos_bmes=False,
+                 max_text_len=19260817,
+                 max_span_len=19260817):
+        self.lexicon2idx = lexicon2idx
+        self.char2idx = char2idx
+        self.bichar2idx = bichar2idx
+        self.seg2idx = seg2idx
+        self.pos2idx = pos2idx
+        self.ner2idx = ner2idx
+        self.label2idx = label2idx
+        self.ignore_pos_bmes = ignore_pos_bmes
+        self.max_text_len = max_text_len
+        self.max_span_len = max_span_len
+        if config.lexicon_emb_pretrain != "off":
+            self.lexicon_trie = LexiconTrie(lexicon2idx)
+        else:
+            self.lexicon_trie = None
+
+    def encode(self, sen, with_lexmatches=True):
+        """
+        Return the Datum of the sentence (None if it is longer than max_text_len)
+        and the lengths of all its gold spans. with_lexmatches=False skips the
+        lexicon matching and leaves lexmatches None.
+        """
+        chars, bichars, segs, labels, poss, ners = [], [], [], [], [], []
+        span_lens = []
+        sen_len = len(sen)
+
+        for cid in range(sen_len):
+            char = sen[cid][0]
+            chars.append(self.char2idx[char] if char in self.char2idx else self.char2idx[Sp.oov])
+
+            bichar = char + sen[cid + 1][0] if cid < sen_len - 1 else char + Sp.eos
+            bichars.append(self.bichar2idx[bichar] if bichar in self.bichar2idx else self.bichar2idx[Sp.oov])
+
+            segs.append(self.seg2idx[sen[cid][1]])
+
+            pos = sen[cid][2]
+            if self.ignore_pos_bmes:
+                pos = pos[2:]
+            poss.append(self.pos2idx[pos])
+
+            ners.append(self.ner2idx[sen[cid][3]])
+
+            if re.match(r"^[BS]", sen[cid][3]):
+                state, label = sen[cid][3].split("-")
+                label_b = cid
+                label_e = cid
+                label_y = self.label2idx[label]
+                if state == 'B':
+                    while True:
+                        next_state, _ = sen[label_e][3].split("-")
+                        if next_state == "E":
+                            break
+                        label_e += 1
+                if state == 'S':
+                    pass
+
+                span_lens.append(label_e - label_b + 1)
+                if label_e - label_b + 1 <= self.max_span_len:
+                    labels.append(SpanLabel(b=label_b, e=label_e, y=label_y))
+
+        if len(chars) >= self.max_text_len:
+            return None, span_lens
+
+        if config.lexicon_emb_pretrain != "off" and with_lexmatches:
+            if config.match_mode == "naive":
+                lexmatches = match_lex_naive(group_fields(sen, indices=0),
+                                             lexicon2idx=self.lexicon2idx,
+                                             lexicon_trie=self.lexicon_trie)
+            elif config.match_mode == "middle":
+                lexmatches = match_lex_middle(group_fields(sen, indices=0),
+                                              lexicon2idx=self.lexicon2idx,
+                                              lexicon_trie=self.lexicon_trie)
+            elif config.match_mode == "mix":
+                lexmatches = match_lex_mix(group_fields(sen, indices=0),
+                                           lexicon2idx=self.lexicon2idx,
+                                           lexicon_trie=self.lexicon_trie)
+            elif config.match_mode == "off":
+                lexmatches = None
+            else:
+                raise Exception
+        else:
+            lexmatches = None
+
+        return Datum(chars=chars, bichars=bichars, segs=segs,
+                     poss=poss, ners=ners, labels=labels,
+                     lexmatches=lexmatches,
+                     span_ys=gen_span_ys(sen_len, labels, config.max_span_length)), span_lens
+
+
+__worker_encoder__ = None  # type: SentenceEncoder
+
+
+def _init_encode_worker(encoder):
+    global __worker_encoder__
+    __worker_encoder__ = encoder
+
+
+def _encode_chunk(chunk):
+    return [__worker_encoder__.encode(sen) for sen in chunk]
+
+
+class ColumnarData:
+    """
+    Flat int32 columns of a list of Datum, used as ConllDataSet.data.
+        tokens  : chars/bichars/segs/poss/ners, split by text_offsets
+        labels  : label_bs/label_es/label_ys, split by label_offsets
+        span_ys : the gold label of the fragments(len, max_span_len) of each sentence, split by span_offsets
+        matches : the LexMatches of the fragments(len, max_span_len) of each sentence,
+                  [num_fragments, max_match_num] frag_lexicons/frag_types and match_nums,
+                  split by frag_offsets
+    Sentences are visited in the order of self.index, so sorting and shuffling only
+    permute the index. Indexing/slicing returns Datum, the same as a list of Datum.
+    """
+    token_fields = ("chars", "bichars", "segs", "poss", "ners")
+
+    def __init__(self, max_span_len):
+        self.max_span_len = max_span_len
+        self.has_lexmatches = True
+        self.text_offsets = array.array('q', [0])
+        self.label_offsets = array.array('q', [0])
+        self.frag_offsets = array.array('q', [0])
+        self.span_offsets = array.array('q', [0])
+        for field in self.token_fields:
+            setattr(self, field, array.array('i'))
+        self.label_bs, self.label_es, self.label_ys = array.array('i'), array.array('i'), array.array('i')
+        self.frag_lexicons, self.frag_types = array.array('i'), array.array('i')
+        self.match_nums = array.array('i')
+        self.span_ys = array.array('i')
+        self.index = None
+
+    def append(self, datum: Datum):
+        for field in self.token_fields:
+            getattr(self, field).extend(getattr(datum, field))
+        self.text_offsets.append(len(self.chars))
+        for label in datum.labels:
+            self.label_bs.append(label.b)
+            self.label_es.append(label.e)
+            self.label_ys.append(label.y)
+        self.label_offsets.append(len(self.label_ys))
+        self.span_ys.frombytes(datum.span_ys.tobytes())
+        self.span_offsets.append(len(self.span_ys))
+        if datum.lexmatches is None:
+            self.has_lexmatches = False
+        else:
+            self.frag_lexicons.frombytes(datum.lexmatches.lexicons.astype(np.int32).tobytes())
+            self.frag_types.frombytes(datum.lexmatches.types.astype(np.int32).tobytes())
+            self.match_nums.frombytes(datum.lexmatches.nums.astype(np.int32).tobytes())
+        self.frag_offsets.append(len(self.match_nums))
+
+    def build(self):
+        """ Convert the appended columns to numpy arrays, called once after the last append. """
+        for name in ("text_offsets", "label_offsets", "frag_offsets", "span_offsets"):
+            setattr(self, name, np.array(getattr(self, name), dtype=np.int64))
+        for name in self.token_fields + ("label_bs", "label_es", "label_ys", "match_nums", "span_ys"):
+            setattr(self, name, np.array(getattr(self, name), dtype=np.int32))
+        for name in ("frag_lexicons", "frag_types"):
+            setattr(self, name, np.array(getattr(self, name), dtype=np.int32).reshape(-1, max_match_num))
+        self.index = np.arange(len(self.text_offsets) - 1)
+
+    array_fields = ("text_offsets", "label_offsets", "frag_offsets", "span_offsets") + \
+                   token_fields + \
+                   ("label_bs", "label_es", "label_ys", "frag_lexicons", "frag_types", "match_nums", "span_ys",
+                    "index")
+
+    def to_arrays(self) -> (Dict[str, np.ndarray], dict):
+        arrays = {name: getattr(self, name) for name in self.array_fields}
+        meta = {"max_span_len": self.max_span_len, "has_lexmatches": self.has_lexmatches}
+        return arrays, meta
+
+    @classmethod
+    def from_arrays(cls, arrays, meta):
+        """ Columns may be memory-mapped, the index is copied since it is shuffled. """
+        data = cls(max_span_len=meta["max_span_len"])
+        data.has_lexmatches = meta["has_lexmatches"]
+        for name in cls.array_fields:
+            setattr(data, name, arrays[name])
+        data.index = np.array(arrays["index"])
+        return data
+
+    def text_lens(self) -> np.ndarray:
+        return np.diff(self.text_offsets)[self.index]
+
+    def sort_by_length(self):
+        lens = np.diff(self.text_offsets)
+        self.index = np.argsort(-lens, kind="stable")
+
+    def shuffle(self):
+        random.shuffle(self.index)
+
+    def bucket_by_length(self, batch_size):
+        """
+        Reorder the index so that every batch_size consecutive sentences have
+        similar lengths: sort by length keeping the current order among equal
+        lengths, then shuffle the order of the batches. The incomplete batch
+        stays the last one.
+        """
+        index = self.index[np.argsort(self.text_lens(), kind="stable")]
+        batch_num = len(index) // batch_size
+        batch_ids = list(range(batch_num))
+        random.shuffle(batch_ids)
+        batches = [index[bid * batch_size: (bid + 1) * batch_size] for bid in batch_ids]
+        batches.append(index[batch_num * batch_size:])
+        self.index = np.concatenate(batches)
+
+    def datum(self, sid) -> Datum:
+        text_b, text_e = self.text_offsets[sid], self.text_offsets[sid + 1]
+        tokens = {field: getattr(self, field)[text_b: text_e].tolist() for field in self.token_fields}
+
+        label_b, label_e = self.label_offsets[sid], self.label_offsets[sid + 1]
+        labels = [SpanLabel(b=b, e=e, y=y) for b, e, y in zip(self.label_bs[label_b: label_e].tolist(),
+                                                             self.label_es[label_b: label_e].tolist(),
+                                                             self.label_ys[label_b: label_e].tolist())]
+
+        if self.has_lexmatches:
+            frag_b, frag_e = self.frag_offsets[sid], self.frag_offsets[sid + 1]
+            lexmatches = LexMatches(int(text_e - text_b), self.max_span_len,
+                                    self.frag_lexicons[frag_b: frag_e],
+                                    self.frag_types[frag_b: frag_e],
+                                    self.match_nums[frag_b: frag_e])
+        else:
+            lexmatches = None
+
+        span_ys = self.span_ys[self.span_offsets[sid]: self.span_offsets[sid + 1]]
+
+        return Datum(labels=labels, lexmatches=lexmatches, span_ys=span_ys, **tokens)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self.datum(sid) for sid in self.index[item]]
+        return self.datum(self.index[item])
+
+    def __iter__(self):
+        for sid in self.index:
+            yield self.datum(sid)
+
+
 class ConllDataSet(DataSet):
 
     def __init__(self, data_path,
@@ -207,107 +463,236 @@ class ConllDataSet(DataSet):
                  ignore_pos_bmes=False,
                  max_text_len=19260817,
                  max_span_len=19260817,
-                 sort_by_length=False):
+                 sort_by_length=False,
+                 num_workers=0,
+                 chunk_size=1000):
+        """
+        num_workers > 0 shards the sentences into chunks of chunk_size and encodes
+        them on a process pool; the result is the same as the sequential build.
+        """
         super(ConllDataSet, self).__init__()
+        self.data = ColumnarData(max_span_len=config.max_span_length)
         if config.lexicon_emb_pretrain != "off":
             self.word2idx = lexicon2idx
             self.idx2word = {v: k for k, v in self.word2idx.items()}
 
         sentences = load_sentences(data_path)
+        encoder = SentenceEncoder(lexicon2idx=lexicon2idx,
+                                  char2idx=char2idx, bichar2idx=bichar2idx, seg2idx=seg2idx,
+                                  pos2idx=pos2idx, ner2idx=ner2idx, label2idx=label2idx,
+                                  ignore_pos_bmes=ignore_pos_bmes,
+                                  max_text_len=max_text_len,
+                                  max_span_len=max_span_len)
 
         self.__max_text_len = max_text_len
         self.__max_span_len = max_span_len
         self.__longest_text_len = -1
         self.__longest_span_len = -1
+        # span costs of the current order, by with_matches, cleared by reset
+        self.__span_costs = {}
 
         __span_length_count = defaultdict(lambda: 0)
         __sentence_length_count = defaultdict(lambda: 0)
 
-        for sid in range(len(sentences)):
-            chars, bichars, segs, labels, poss, ners = [], [], [], [], [], []
-
-            sen = sentences[sid]
-            sen_len = len(sen)
-
-            for cid in range(sen_len):
-                char = sen[cid][0]
-                chars.append(char2idx[char] if char in char2idx else char2idx[Sp.oov])
-
-                bichar = char + sen[cid + 1][0] if cid < sen_len - 1 else char + Sp.eos
-                bichars.append(bichar2idx[bichar] if bichar in bichar2idx else bichar2idx[Sp.oov])
-
-                segs.append(seg2idx[sen[cid][1]])
-
-                pos = sen[cid][2]
-                if ignore_pos_bmes:
-                    pos = pos[2:]
-                poss.append(pos2idx[pos])
-
-                ners.append(ner2idx[sen[cid][3]])
-
-                if re.match(r"^[BS]", sen[cid][3]):
-                    state, label = sen[cid][3].split("-")
-                    label_b = cid
-                    label_e = cid
-                    label_y = label2idx[label]
-                    if state == 'B':
-                        while True:
-                            next_state, _ = sen[label_e][3].split("-")
-                            if next_state == "E":
-                                break
-                            label_e += 1
-                    if state == 'S':
-                        pass
-
-                    __span_length_count[label_e - label_b + 1] += 1
-                    if label_e - label_b + 1 <= max_span_len:
-                        labels.append(SpanLabel(b=label_b, e=label_e, y=label_y))
-                        self.__longest_span_len = max(self.__longest_span_len, label_e - label_b + 1)
-
-            __sentence_length_count[len(chars)] += 1
-            if len(chars) < max_text_len:
-                if config.lexicon_emb_pretrain != "off":
-                    if config.match_mode == "naive":
-                        lexmatches = match_lex_naive(group_fields(sen, indices=0),
-                                                     lexicon2idx=lexicon2idx)
-                        # for ele in lexmatches:
-                        #     print("".join(group_fields(sen, indices=0)[ele[0][0]: ele[0][1]+ 1]))
-                        #     for word_idx, match_type in ele[1]:
-                        #         print(">>\t" ,self.idx2word[word_idx], idx2match_naive[match_type])
-                    elif config.match_mode == "middle":
-                        lexmatches = match_lex_middle(group_fields(sen, indices=0),
-                                                      lexicon2idx=lexicon2idx)
-                        # for ele in lexmatches:
-                        #     print("".join(group_fields(sen, indices=0)[ele[0][0]: ele[0][1] + 1]))
-                        #     for word_idx, match_type in ele[1]:
-                        #         print(">>\t", self.idx2word[word_idx], idx2match_middle[match_type])
-                    elif config.match_mode == "mix":
-                        lexmatches = match_lex_mix(group_fields(sen, indices=0),
-                                                   lexicon2idx=lexicon2idx)
-                        # for ele in lexmatches:
-                        #     print("".join(group_fields(sen, indices=0)[ele[0][0]: ele[0][1] + 1]))
-                        #     for word_idx, match_type in ele[1]:
-                        #         print(">>\t", self.idx2word[word_idx], idx2match_mix[match_type])
-                    elif config.match_mode == "off":
-                        lexmatches = None
-                    else:
-                        raise Exception
-                else:
-                    lexmatches = None
-
-                self.data.append(Datum(chars=chars, bichars=bichars, segs=segs,
-                                       poss=poss, ners=ners, labels=labels,
-                                       lexmatches=lexmatches))
-                self.__longest_text_len = max(self.__longest_text_len, len(chars))
+        if num_workers > 0:
+            chunks = [sentences[i: i + chunk_size] for i in range(0, len(sentences), chunk_size)]
+            with multiprocessing.Pool(num_workers,
+                                      initializer=_init_encode_worker,
+                                      initargs=(encoder,)) as pool:
+                encoded = [ele for chunk in pool.imap(_encode_chunk, chunks) for ele in chunk]
+        else:
+            encoded = map(encoder.encode, sentences)
+
+        for sen, (datum, span_lens) in zip(sentences, encoded):
+            for span_len in span_lens:
+                __span_length_count[span_len] += 1
+                if span_len <= max_span_len:
+                    self.__longest_span_len = max(self.__longest_span_len, span_len)
 
+            __sentence_length_count[len(sen)] += 1
+            if datum is not None:
+                self.data.append(datum)
+                self.__longest_text_len = max(self.__longest_text_len, len(datum.chars))
+
+        self.data.build()
         if sort_by_length:
-            self.data = sorted(self.data, key=lambda x: len(x[0]), reverse=True)
+            self.data.sort_by_length()
+        log("Dataset statistics for {}".format(data_path))
+        log("Sentence")
+        analyze_length_count(__sentence_length_count)
+        log("Span")
+        analyze_length_count(__span_length_count)
+
+    def reset(self, shuffle=True, bucket_batch_size=0):
+        """
+        bucket_batch_size > 0 groups the sentences into batches of that size with
+        similar lengths, in a random batch order; shuffle decides whether the
+        sentences of the same length are shuffled as well.
+        """
+        super(ConllDataSet, self).reset(shuffle=False)
+        if shuffle:
+            self.data.shuffle()
+        if bucket_batch_size > 0:
+            self.data.bucket_by_length(bucket_batch_size)
+        self.__span_costs = {}
+
+    def span_costs(self, with_matches=False) -> np.ndarray:
+        """
+        Number of enumerated fragments of each sentence in the current order,
+        times max_match_num (the lexicon memory slots) if with_matches.
+        Computed once per order.
+        """
+        if with_matches not in self.__span_costs:
+            text_lens = self.data.text_lens()
+            span_lens = np.minimum(text_lens, config.max_span_length)
+            costs = span_lens * text_lens - span_lens * (span_lens - 1) // 2
+            if with_matches:
+                costs = costs * max_match_num
+            self.__span_costs[with_matches] = costs
+        return self.__span_costs[with_matches]
+
+    def padding_waste(self, batch_size, budget=0, with_matches=False):
+        """
+        Ratio of padded tokens when the current order is cut into batches of batch_size,
+        or by next_batch_by_budget with the span costs if budget > 0.
+        """
+        text_lens = self.data.text_lens()
+        costs = self.span_costs(with_matches) if budget > 0 else None
+        padded_num = 0
+        start = 0
+        while start < len(text_lens):
+            end = budget_end(costs, start, budget) if budget > 0 else start + batch_size
+            batch_lens = text_lens[start: end]
+            padded_num += batch_lens.max() * len(batch_lens)
+            start = end
+        return 1 - text_lens.sum() / padded_num
+
+    def to_arrays(self) -> (Dict[str, np.ndarray], dict):
+        arrays, data_meta = self.data.to_arrays()
+        meta = {"data": data_meta,
+                "max_text_len": self.__max_text_len,
+                "max_span_len": self.__max_span_len,
+                "longest_text_len": self.__longest_text_len,
+                "longest_span_len": self.__longest_span_len}
+        return arrays, meta
+
+    @classmethod
+    def from_arrays(cls, arrays, meta):
+        dataset = cls.__new__(cls)
+        DataSet.__init__(dataset)
+        dataset.data = ColumnarData.from_arrays(arrays, meta["data"])
+        dataset.__max_text_len = meta["max_text_len"]
+        dataset.__max_span_len = meta["max_span_len"]
+        dataset.__longest_text_len = meta["longest_text_len"]
+        dataset.__longest_span_len = meta["longest_span_len"]
+        dataset.__span_costs = {}
+        return dataset
+
+    @property
+    def longest_text_len(self):
+        return self.__longest_text_len
+
+    @property
+    def longest_span_len(self):
+        return self.__longest_span_len
+
+
+class StreamingConllDataSet(DataSet):
+    """
+    ConllDataSet for corpora larger than memory. The file is read lazily and the
+    sentences are encoded and lexicon-matched when they are drawn. Shuffling
+    draws the batches randomly from a buffer of shuffle_buffer sentences.
+    The first pass over the file only counts the sentences and the length
+    statistics.
+    """
+
+    def __init__(self, data_path,
+                 lexicon2idx,
+                 char2idx, bichar2idx, seg2idx, pos2idx, ner2idx, label2idx,
+                 ignore_pos_bmes=False,
+                 max_text_len=19260817,
+                 max_span_len=19260817,
+                 shuffle_buffer=10000):
+        super(StreamingConllDataSet, self).__init__()
+        self.data_path = data_path
+        self.shuffle_buffer = shuffle_buffer
+        self.encoder = SentenceEncoder(lexicon2idx=lexicon2idx,
+                                       char2idx=char2idx, bichar2idx=bichar2idx, seg2idx=seg2idx,
+                                       pos2idx=pos2idx, ner2idx=ner2idx, label2idx=label2idx,
+                                       ignore_pos_bmes=ignore_pos_bmes,
+                                       max_text_len=max_text_len,
+                                       max_span_len=max_span_len)
+        self.__size = 0
+        self.__longest_text_len = -1
+        self.__longest_span_len = -1
+        __span_length_count = defaultdict(lambda: 0)
+        __sentence_length_count = defaultdict(lambda: 0)
+        for sen in iter_sentences(data_path):
+            datum, span_lens = self.encoder.encode(sen, with_lexmatches=False)
+            for span_len in span_lens:
+                __span_length_count[span_len] += 1
+                if span_len <= max_span_len:
+                    self.__longest_span_len = max(self.__longest_span_len, span_len)
+            __sentence_length_count[len(sen)] += 1
+            if datum is not None:
+                self.__size += 1
+                self.__longest_text_len = max(self.__longest_text_len, len(datum.chars))
         log("Dataset statistics for {}".format(data_path))
         log("Sentence")
         analyze_length_count(__sentence_length_count)
         log("Span")
         analyze_length_count(__span_length_count)
 
+        self.__stream = None
+        self.__buffer = []
+        self.__buffer_size = 0
+        self.__drawn = 0
+        self.reset(shuffle=False)
+
+    def __encoded(self):
+        for sen in iter_sentences(self.data_path):
+            datum, _ = self.encoder.encode(sen)
+            if datum is not None:
+                yield datum
+
+    def __draw(self) -> Datum:
+        while len(self.__buffer) < self.__buffer_size:
+            datum = next(self.__stream, None)
+            if datum is None:
+                break
+            self.__buffer.append(datum)
+        if self.__buffer_size > 1:
+            idx = random.randrange(len(self.__buffer))
+            self.__buffer[idx], self.__buffer[-1] = self.__buffer[-1], self.__buffer[idx]
+        self.__drawn += 1
+        return self.__buffer.pop()
+
+    def next_batch(self, batch_size, fill_batch=True):
+        """
+        The stream can not go back, so the last batch only has the rest
+        sentences even if fill_batch.
+        """
+        batch_size = min(batch_size, self.size - self.__drawn)
+        return [self.__draw() for _ in range(batch_size)]
+
+    def reset(self, shuffle=True, bucket_batch_size=0):
+        """
+        Bucketing needs the lengths of the whole epoch, bucket_batch_size is
+        ignored when streaming.
+        """
+        self.__stream = self.__encoded()
+        self.__buffer = []
+        self.__buffer_size = max(self.shuffle_buffer, 1) if shuffle else 1
+        self.__drawn = 0
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def finished(self):
+        return self.__drawn == self.size
+
     @property
     def longest_text_len(self):
         return self.__longest_text_len
@@ -328,54 +713,55 @@ def fragments(sentence_len, max_span_len) -> List[FragIdx]:
     return ret
 
 
-def match_lex_mix(chars, lexicon2idx):
-    mapping_dict = {}  # type: Dict[FragIdx, int]
-    ret = []
-    length = len(chars)
-    # print(self.__max_span_len)
-    # print(fragments(length, self.__max_span_len))
-    for i, j in fragments(length, config.max_span_length):
-        lexicon = "".join(chars[i:j + 1])
-        if lexicon in lexicon2idx:
-            mapping_dict[FragIdx(i, j)] = lexicon2idx[lexicon]
-    for i, j in fragments(length, config.max_span_length):
-        matched_lexicons = []
-        for sub_i in upto(i, j):
-            for sub_j in upto(sub_i, j):
-                if FragIdx(sub_i, sub_j) in mapping_dict:
-                    if sub_i == i and sub_j == j:
-                        m_idx = match2idx_mix['full_match']
-                    elif sub_i == i and sub_j != j:
-                        if sub_j == i:
-                            m_idx = match2idx_mix["pre_1"]
-                        elif sub_j == i + 1:
-                            m_idx = match2idx_mix["pre_2"]
-                        else:
-                            m_idx = match2idx_mix["pre_3"]
-                    elif sub_i != i and sub_j == j:
-                        if j == sub_i:
-                            m_idx = match2idx_mix["suff_1"]
-                        elif j == sub_i + 1:
-                            m_idx = match2idx_mix["suff_2"]
-                        else:
-                            m_idx = match2idx_mix["suff_3"]
-                    elif sub_i != sub_j:
-                        m_idx = match2idx_mix["inter_match"]
-                    else:
-                        continue
-                    matched_lexicons.append(
-                        pair(mapping_dict[FragIdx(sub_i, sub_j)], m_idx)
-                    )
-        matched_lexicons.sort(key=lambda x: x[1])
-        matched_lexicons = matched_lexicons[:max_match_num]
-        if len(matched_lexicons) == 0:
-            matched_lexicons.append(
-                pair(lexicon2idx[Sp.non], match2idx_mix["no_match"])
-            )
-        ret.append(
-            (pair(i, j), matched_lexicons)
-        )
-    return ret
+def gen_span_ys(sentence_len, labels, max_span_len) -> np.ndarray:
+    """
+    Gold label of each fragment in the order of fragments(sentence_len, max_span_len),
+    0 for the fragments that are not a labelled span.
+    """
+    frag_nums = np.minimum(max_span_len, sentence_len - np.arange(sentence_len))
+    frag_begins = np.concatenate([[0], np.cumsum(frag_nums)[:-1]]).astype(np.int64)
+    span_ys = np.zeros(frag_nums.sum(), dtype=np.int32)
+    # the first label of a span wins if it is labelled twice
+    for span in reversed(labels):
+        if span.e - span.b < max_span_len:
+            span_ys[frag_begins[span.b] + span.e - span.b] = span.y
+    return span_ys
+
+
+class LexiconTrie:
+    """
+    Character trie over the keys of lexicon2idx. Walking it from every start
+    position finds all lexicons inside the span window without building the
+    "".join(chars[i:j + 1]) string of each fragment.
+    """
+
+    def __init__(self, lexicon2idx):
+        self.root = {}
+        for lexicon, idx in lexicon2idx.items():
+            node = self.root
+            for ch in lexicon:
+                node = node.setdefault(ch, {})
+            node[None] = idx
+
+    def match(self, chars, max_span_len, min_span_len=1) -> Dict[FragIdx, int]:
+        """
+        Return {FragIdx(i, j): lexicon_idx} for all fragments whose joined chars
+        is a lexicon, inserted in the same order as fragments(len(chars), max_span_len).
+        """
+        mapping_dict = {}
+        length = len(chars)
+        for i in range(length):
+            node = self.root
+            for j in range(i, min(i + max_span_len, length)):
+                for ch in chars[j]:
+                    node = node.get(ch)
+                    if node is None:
+                        break
+                if node is None:
+                    break
+                if None in node and j - i + 1 >= min_span_len:
+                    mapping_dict[FragIdx(i, j)] = node[None]
+        return mapping_dict
 
 
 def upto(a, b) -> range:
@@ -386,101 +772,203 @@ def downto(b, a) -> range:
     return range(b, a - 1, -1)
 
 
-def match_lex_middle(chars, lexicon2idx):
-    mapping_dict = {}  # type: Dict[FragIdx, int]
-    ret = []
-    length = len(chars)
-    # print(self.__max_span_len)
-    # print(fragments(length, self.__max_span_len))
-    for i, j in fragments(length, config.max_span_length):
-        lexicon = "".join(chars[i:j + 1])
-        if lexicon in lexicon2idx:
-            mapping_dict[FragIdx(i, j)] = lexicon2idx[lexicon]
-    for i, j in fragments(length, config.max_span_length):
-        matched_lexicons = []
-        for sub_i in upto(i, j):
-            for sub_j in upto(sub_i, j):
-                if FragIdx(sub_i, sub_j) in mapping_dict:
-                    if sub_i == i and sub_j == j:
-                        m_idx = match2idx_middle['full_match']
-                    elif sub_i == i and sub_j != j:
-                        if sub_j == i:
-                            m_idx = match2idx_middle["pre_1"]
-                        else:
-                            m_idx = match2idx_middle["pre_2"]
-                    elif sub_i != i and sub_j == j:
-                        if j == sub_i:
-                            m_idx = match2idx_middle["suff_1"]
-                        else:
-                            m_idx = match2idx_middle["suff_2"]
-                    elif sub_i != sub_j:
-                        m_idx = match2idx_middle["inter_match"]
-                    else:
-                        continue
-                    matched_lexicons.append(
-                        pair(mapping_dict[FragIdx(sub_i, sub_j)], m_idx)
-                    )
-        matched_lexicons.sort(key=lambda x: x[1])
-        matched_lexicons = matched_lexicons[:max_match_num]
-        if len(matched_lexicons) == 0:
-            matched_lexicons.append(
-                pair(lexicon2idx[Sp.non], match2idx_middle["no_match"])
-            )
-        ret.append(
-            (pair(i, j), matched_lexicons)
-        )
-    return ret
+def match_type(i, j, sub_i, sub_j, match_mode) -> int:
+    """
+    Match type of the lexicon at [sub_i, sub_j] inside the fragment [i, j],
+    -1 if the lexicon is not used as a match of the fragment.
+    """
+    if match_mode == "mix":
+        if sub_i == i and sub_j == j:
+            return match2idx_mix['full_match']
+        elif sub_i == i and sub_j != j:
+            if sub_j == i:
+                return match2idx_mix["pre_1"]
+            elif sub_j == i + 1:
+                return match2idx_mix["pre_2"]
+            else:
+                return match2idx_mix["pre_3"]
+        elif sub_i != i and sub_j == j:
+            if j == sub_i:
+                return match2idx_mix["suff_1"]
+            elif j == sub_i + 1:
+                return match2idx_mix["suff_2"]
+            else:
+                return match2idx_mix["suff_3"]
+        elif sub_i != sub_j:
+            return match2idx_mix["inter_match"]
+        else:
+            return -1
+    elif match_mode == "middle":
+        if sub_i == i and sub_j == j:
+            return match2idx_middle['full_match']
+        elif sub_i == i and sub_j != j:
+            if sub_j == i:
+                return match2idx_middle["pre_1"]
+            else:
+                return match2idx_middle["pre_2"]
+        elif sub_i != i and sub_j == j:
+            if j == sub_i:
+                return match2idx_middle["suff_1"]
+            else:
+                return match2idx_middle["suff_2"]
+        elif sub_i != sub_j:
+            return match2idx_middle["inter_match"]
+        else:
+            return -1
+    elif match_mode == "naive":
+        if sub_i == i:
+            if sub_j == j:
+                return match2idx_naive["full_match"]
+            else:
+                return match2idx_naive['prefix_match']
+        else:
+            if sub_j == j:
+                return match2idx_naive['suffix_match']
+            else:
+                return match2idx_naive['inter_match']
+    else:
+        raise Exception
 
 
-def match_lex_naive(chars, lexicon2idx):
-    mapping_dict = {}  # type: Dict[FragIdx, int]
-    ret = []
+@lru_cache(maxsize=None)
+def match_type_table(max_span_len, match_mode) -> np.ndarray:
+    """
+    table[n, a, l] is the match type of the sub-span with offset a and length l
+    inside a fragment of length n, -1 if it is not a match.
+    """
+    table = np.full((max_span_len + 1, max_span_len, max_span_len + 1), -1, dtype=np.int64)
+    for n in upto(1, max_span_len):
+        for sub_i in range(n):
+            for sub_j in range(sub_i, n):
+                table[n, sub_i, sub_j - sub_i + 1] = match_type(0, n - 1, sub_i, sub_j, match_mode)
+    return table
+
+
+@lru_cache(maxsize=None)
+def match_candidates(max_span_len, match_mode):
+    """
+    For a fragment of length n, row n lists the (offset, length, type) of its
+    sub-spans that are matches, in the order matches are kept: sorted by the
+    match type, then by the position of the sub-span. Rows are padded with
+    (0, 1, -1).
+    """
+    table = match_type_table(max_span_len, match_mode)
+    max_cand = max_span_len * (max_span_len + 1) // 2
+    offsets = np.zeros((max_span_len + 1, max_cand), dtype=np.int64)
+    lengths = np.ones((max_span_len + 1, max_cand), dtype=np.int64)
+    types = np.full((max_span_len + 1, max_cand), -1, dtype=np.int64)
+    for n in upto(1, max_span_len):
+        cands = []
+        for sub_i in range(n):
+            for sub_len in upto(1, n - sub_i):
+                if table[n, sub_i, sub_len] != -1:
+                    cands.append((table[n, sub_i, sub_len], sub_i, sub_len))
+        cands.sort(key=lambda x: x[0])
+        for cid, (m_idx, sub_i, sub_len) in enumerate(cands):
+            offsets[n, cid] = sub_i
+            lengths[n, cid] = sub_len
+            types[n, cid] = m_idx
+    return offsets, lengths, types
+
+
+@lru_cache(maxsize=None)
+def fragment_arrays(sentence_len, max_span_len):
+    frags = np.array(fragments(sentence_len, max_span_len), dtype=np.int64).reshape(-1, 2)
+    return frags[:, 0], frags[:, 1]
+
+
+class LexMatches:
+    """
+    The lexicon matches of the fragments(sentence_len, max_span_len) of a sentence:
+        lexicons/types : [num_fragments, max_match_num] int32, padded with 0
+        nums           : [num_fragments] int32, the number of matches of each fragment
+    Indexing/iterating gives ((i, j), [(lexicon_idx, match_type), ...]) of a fragment,
+    the same as a list of the matches.
+    """
+
+    def __init__(self, sentence_len, max_span_len, lexicons, types, nums):
+        self.sentence_len = sentence_len
+        self.max_span_len = max_span_len
+        self.lexicons = lexicons
+        self.types = types
+        self.nums = nums
+
+    def __len__(self):
+        return len(self.nums)
+
+    def __getitem__(self, fid):
+        i, j = fragments(self.sentence_len, self.max_span_len)[fid]
+        num = self.nums[fid]
+        return pair(i, j), list(zip(self.lexicons[fid, :num].tolist(), self.types[fid, :num].tolist()))
+
+    def __iter__(self):
+        for fid in range(len(self)):
+            yield self[fid]
+
+
+def match_lex(chars, lexicon2idx, match_mode, lexicon_trie=None) -> LexMatches:
+    """
+    Return the LexMatches of every fragment in fragments(len(chars), config.max_span_length),
+    which reads as [((i, j), [(lexicon_idx, match_type), ...]), ...]. A fragment keeps at
+    most max_match_num matches, and gets a single <non> no_match if it has none.
+    """
+    if lexicon_trie is None:
+        lexicon_trie = LexiconTrie(lexicon2idx)
+    match2idx = {"naive": match2idx_naive,
+                 "middle": match2idx_middle,
+                 "mix": match2idx_mix}[match_mode]
+    # single-char lexicons are ignored in the naive mode
+    mapping_dict = lexicon_trie.match(chars, config.max_span_length,
+                                      min_span_len=2 if match_mode == "naive" else 1)  # type: Dict[FragIdx, int]
     length = len(chars)
-    # print(self.__max_span_len)
-    # print(fragments(length, self.__max_span_len))
-    for i, j in fragments(length, config.max_span_length):
-        if i != j:
-            lexicon = "".join(chars[i:j + 1])
-            if lexicon in lexicon2idx:
-                mapping_dict[FragIdx(i, j)] = lexicon2idx[lexicon]
-    for i, j in fragments(length, config.max_span_length):
-        matched_lexicons = []
-        for sub_i in upto(i, j):
-            for sub_j in upto(sub_i, j):
-                if FragIdx(sub_i, sub_j) in mapping_dict:
-                    if sub_i == i:
-                        if sub_j == j:
-                            m_idx = match2idx_naive["full_match"]
-                        else:
-                            m_idx = match2idx_naive['prefix_match']
-                    else:
-                        if sub_j == j:
-                            m_idx = match2idx_naive['suffix_match']
-                        else:
-                            m_idx = match2idx_naive['inter_match']
-                    matched_lexicons.append(
-                        pair(mapping_dict[FragIdx(sub_i, sub_j)], m_idx)
-                    )
-        matched_lexicons.sort(key=lambda x: x[1])
-        matched_lexicons = matched_lexicons[:max_match_num]
-        if len(matched_lexicons) == 0:
-            matched_lexicons.append(
-                pair(lexicon2idx[Sp.non], match2idx_naive["no_match"])
-            )
-        ret.append(
-            (pair(i, j), matched_lexicons)
-        )
-    return ret
+    frag_bs, frag_es = fragment_arrays(length, config.max_span_length)
+
+    # hits[i, l - 1] is the lexicon starting at i with length l, -1 if none
+    hits = np.full((length, config.max_span_length), -1, dtype=np.int64)
+    for (i, j), lex_idx in mapping_dict.items():
+        hits[i, j - i] = lex_idx
+
+    offsets, lengths, types = match_candidates(config.max_span_length, match_mode)
+    frag_lens = frag_es - frag_bs + 1
+    cand_types = types[frag_lens]
+    cand_lexicons = hits[frag_bs[:, None] + offsets[frag_lens], lengths[frag_lens] - 1]
+    found = (cand_types != -1) & (cand_lexicons != -1)
+    found &= np.cumsum(found, axis=1) <= max_match_num
+
+    # pack the found candidates of each fragment to the left of [num_fragments, max_match_num]
+    frag_ids, cand_ids = np.nonzero(found)
+    slot_ids = np.cumsum(found, axis=1)[frag_ids, cand_ids] - 1
+    lexicons = np.zeros((len(frag_bs), max_match_num), dtype=np.int32)
+    types = np.zeros((len(frag_bs), max_match_num), dtype=np.int32)
+    lexicons[frag_ids, slot_ids] = cand_lexicons[frag_ids, cand_ids]
+    types[frag_ids, slot_ids] = cand_types[frag_ids, cand_ids]
+    nums = found.sum(axis=1).astype(np.int32)
+
+    no_match = nums == 0
+    lexicons[no_match, 0] = lexicon2idx[Sp.non]
+    types[no_match, 0] = match2idx["no_match"]
+    nums[no_match] = 1
+    return LexMatches(length, config.max_span_length, lexicons, types, nums)
+
+
+def match_lex_mix(chars, lexicon2idx, lexicon_trie=None):
+    return match_lex(chars, lexicon2idx, "mix", lexicon_trie)
+
+
+def match_lex_middle(chars, lexicon2idx, lexicon_trie=None):
+    return match_lex(chars, lexicon2idx, "middle", lexicon_trie)
+
+
+def match_lex_naive(chars, lexicon2idx, lexicon_trie=None):
+    return match_lex(chars, lexicon2idx, "naive", lexicon_trie)
 
 
 def gen_lexicon_vocab(*data_paths, word2vec_path, out_folder, use_cache=False):
     if use_cache and os.path.exists("{}/lexicon.vocab".format(out_folder)):
         log("cache for lexicon vocab exists.")
         return
-    words = set()
-    for line in open(word2vec_path, encoding="utf8", errors="ignore"):
-        word = re.split(r"\s+", line.strip())[0]
-        words.add(word)
+    # only the words are streamed, the vectors are not parsed
+    words = set(read_word2vec_words(word2vec_path))
 
     lexicon = {Sp.pad: 0, Sp.oov: 1, Sp.non: 2, Sp.sos: 3, Sp.eos: 4}
     for data_path in data_paths:
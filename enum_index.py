@@ -1,5 +1,11 @@
 from functools import lru_cache
 from typing import List
+import numpy as np
+import torch
+
+# 缓存的 batch 级下标 Tensor 的个数上限，按 (lengths, max_span_len) 缓存在 CPU 上。
+# 训练时每个 epoch 都会打乱，lengths 几乎不会重复，只有 dev/test 的 batch 会命中，故取较小的值
+__index_cache_size__ = 64
 
 """
 对于序列 [ABCD, EF], 他们的片段按照如下排序：
@@ -24,25 +30,18 @@ def gen_inc_context_ids(lengths=(4, 2), max_span_len=3):
     """
     max_len = max(lengths)
     b2e_ids, e2b_ids = [], []
-    base_row = 0
-    for length in lengths:
+    for sid, length in enumerate(lengths):
         it_b2e_1d, it_e2b_1d = _gen_inc_context_ids(length, max_span_len)
-        b2e_ids.extend(list(map(lambda x: x + base_row, it_b2e_1d)))
-        e2b_ids.extend(list(map(lambda x: x + base_row, it_e2b_1d)))
-        base_row += max_len
-    return b2e_ids, e2b_ids
+        b2e_ids.append(it_b2e_1d + sid * max_len)
+        e2b_ids.append(it_e2b_1d + sid * max_len)
+    return np.concatenate(b2e_ids), np.concatenate(e2b_ids)
 
 
 @lru_cache(maxsize=None)
 def _gen_inc_context_ids(length=4, max_span_len=3):
     # 保存 i 代表第 i 个 hidden state
-    b2e_1d, e2b_1d = [], []
-    for i in range(length):
-        for j in range(max_span_len):
-            if i + j < length:
-                b2e_1d.append(i + j)
-                e2b_1d.append(length - i - 1)
-    return b2e_1d, e2b_1d
+    i, j = _gen_span_pairs(length, max_span_len)
+    return i + j, length - i - 1
 
 
 def gen_exc_context_ids(lengths=(4, 2), max_span_len=3):
@@ -62,24 +61,18 @@ def gen_exc_context_ids(lengths=(4, 2), max_span_len=3):
     """
     max_len = max(lengths)
     b2e_ids, e2b_ids = [], []
-    base_row = 0
-    for length in lengths:
+    for sid, length in enumerate(lengths):
         it_b2e_1d, it_e2b_1d = _gen_exc_context_ids(length, max_span_len)
-        b2e_ids.extend(list(map(lambda x: x + base_row if x != -1 else -1, it_b2e_1d)))
-        e2b_ids.extend(list(map(lambda x: x + base_row if x != -1 else -1, it_e2b_1d)))
-        base_row += max_len
-    return b2e_ids, e2b_ids
+        b2e_ids.append(np.where(it_b2e_1d != -1, it_b2e_1d + sid * max_len, -1))
+        e2b_ids.append(np.where(it_e2b_1d != -1, it_e2b_1d + sid * max_len, -1))
+    return np.concatenate(b2e_ids), np.concatenate(e2b_ids)
 
 
+@lru_cache(maxsize=None)
 def _gen_exc_context_ids(length=4, max_span_len=3):
     # 保存 i 代表第 i 个 hidden state
-    b2e_1d, e2b_1d = [], []
-    for i in range(length):
-        for j in range(max_span_len):
-            if i + j < length:
-                b2e_1d.append(i - 1)
-                e2b_1d.append(length - 1 - i - j - 1)
-    return b2e_1d, e2b_1d
+    i, j = _gen_span_pairs(length, max_span_len)
+    return i - 1, length - 1 - i - j - 1
 
 
 # x, y = gen_context_ids((4, 2, 3), 3)
@@ -111,22 +104,92 @@ def gen_fragment_ids(lengths=(4, 2), max_span_len=3):
     b2e_ids, e2b_ids = [], []
     base_row = 0
     for length in lengths:
-        b2e_2d, e2b_2d = _gen_fragment_ids(length, max_span_len)
-        it_b2e_idx = list(map(lambda pair: pair[0] * max_span_len + pair[1], b2e_2d))
-        it_e2b_idx = list(map(lambda pair: pair[0] * max_span_len + pair[1], e2b_2d))
-        b2e_ids.extend(list(map(lambda x: x + base_row, it_b2e_idx)))
-        e2b_ids.extend(list(map(lambda x: x + base_row, it_e2b_idx)))
+        it_b2e_idx, it_e2b_idx = _gen_fragment_ids(length, max_span_len)
+        b2e_ids.append(it_b2e_idx + base_row)
+        e2b_ids.append(it_e2b_idx + base_row)
         base_row += length * max_span_len
-    return b2e_ids, e2b_ids
+    return np.concatenate(b2e_ids), np.concatenate(e2b_ids)
 
 
 @lru_cache(maxsize=None)
 def _gen_fragment_ids(length=4, max_span_len=3):
-    # 保存 (i, j) 代表该句子的第 i 个 RNN 的第 j 个 hidden state
-    b2e_2d, e2b_2d = [], []
-    for i in range(length):
-        for j in range(max_span_len):
-            if i + j < length:
-                b2e_2d.append((i, j))
-                e2b_2d.append((length - i - j - 1, j))
-    return b2e_2d, e2b_2d
+    # (i, j) 代表该句子的第 i 个 RNN 的第 j 个 hidden state，保存其 flatten 后的下标 i * max_span_len + j
+    i, j = _gen_span_pairs(length, max_span_len)
+    return i * max_span_len + j, (length - i - j - 1) * max_span_len + j
+
+
+def _gen_span_pairs(length, max_span_len):
+    # 按片段的顺序返回所有 i + j < length 的 (i, j)，即从第 i 个字开始、长度为 j + 1 的片段
+    i, j = np.divmod(np.arange(length * max_span_len), max_span_len)
+    in_sentence = i + j < length
+    return i[in_sentence], j[in_sentence]
+
+
+def span_num(lengths, max_span_len):
+    lengths = np.asarray(lengths)
+    span_lens = np.minimum(lengths, max_span_len)
+    return int((span_lens * lengths - span_lens * (span_lens - 1) // 2).sum())
+
+
+def fragment_id_tensors(lengths: tuple, max_span_len, device):
+    """
+    gen_fragment_ids 的 LongTensor 版本，lengths 须为 tuple。
+    """
+    return tuple(ids.to(device, non_blocking=True) for ids in _fragment_id_tensors(lengths, max_span_len))
+
+
+@lru_cache(maxsize=__index_cache_size__)
+def _fragment_id_tensors(lengths: tuple, max_span_len):
+    b2e_ids, e2b_ids = gen_fragment_ids(lengths, max_span_len)
+    assert len(b2e_ids) == span_num(lengths, max_span_len)
+    return torch.from_numpy(b2e_ids), torch.from_numpy(e2b_ids)
+
+
+def inc_context_id_tensors(lengths: tuple, max_span_len, device):
+    """
+    gen_inc_context_ids 的 LongTensor 版本，lengths 须为 tuple。
+    """
+    return tuple(ids.to(device, non_blocking=True) for ids in _inc_context_id_tensors(lengths, max_span_len))
+
+
+@lru_cache(maxsize=__index_cache_size__)
+def _inc_context_id_tensors(lengths: tuple, max_span_len):
+    b2e_ids, e2b_ids = gen_inc_context_ids(lengths, max_span_len)
+    return torch.from_numpy(b2e_ids), torch.from_numpy(e2b_ids)
+
+
+def exc_context_id_tensors(lengths: tuple, max_span_len, device):
+    """
+    gen_exc_context_ids 的 LongTensor 版本，lengths 须为 tuple。
+    -1 被替换为 len(lengths) * max(lengths)，即 flatten 后的 outputs 之后拼接的起始向量所在的行。
+    """
+    return tuple(ids.to(device, non_blocking=True) for ids in _exc_context_id_tensors(lengths, max_span_len))
+
+
+@lru_cache(maxsize=__index_cache_size__)
+def _exc_context_id_tensors(lengths: tuple, max_span_len):
+    pad_index = len(lengths) * max(lengths)
+    b2e_ids, e2b_ids = gen_exc_context_ids(lengths, max_span_len)
+    b2e_ids = np.where(b2e_ids != -1, b2e_ids, pad_index)
+    e2b_ids = np.where(e2b_ids != -1, e2b_ids, pad_index)
+    return torch.from_numpy(b2e_ids), torch.from_numpy(e2b_ids)
+
+
+def boundary_id_tensors(lengths: tuple, max_span_len, device):
+    """
+    按片段顺序返回每个片段的起始、结束 token 在 flatten 后的 [batch_size * max(lengths), dim] 中的行，
+    以及片段长度 - 1，lengths 须为 tuple。
+    """
+    return tuple(ids.to(device, non_blocking=True) for ids in _boundary_id_tensors(lengths, max_span_len))
+
+
+@lru_cache(maxsize=__index_cache_size__)
+def _boundary_id_tensors(lengths: tuple, max_span_len):
+    max_len = max(lengths)
+    b_ids, e_ids, widths = [], [], []
+    for sid, length in enumerate(lengths):
+        i, j = _gen_span_pairs(length, max_span_len)
+        b_ids.append(i + sid * max_len)
+        e_ids.append(i + j + sid * max_len)
+        widths.append(j)
+    return tuple(torch.from_numpy(np.concatenate(ids)) for ids in (b_ids, e_ids, widths))
@@ -1,6 +1,6 @@
 from buff import *
-from enum_index import gen_fragment_ids
-from seq_encoder import BaseSeqEncoder
+from enum_index import fragment_id_tensors, boundary_id_tensors
+from seq_encoder import BaseSeqEncoder, FofeSeqEncoder, AverageSeqEncoder, RNNSeqEncoder
 
 
 class FragmentEnumerator(torch.nn.Module):
@@ -17,32 +17,37 @@ class FragmentEnumerator(torch.nn.Module):
 
     def enumerate_inputs(self, inputs, lengths):
         """
-        通过 for 循环枚举每个句子里的所有最长 span，并拼接起来。
+        枚举每个句子里的所有最长 span，并拼接起来：
+            正向为 inputs 的窗口，反向为按长度翻转后的 inputs 的窗口，超出句子长度的部分补 0，
+            窗口由 unfold 一次取出，再按长度选出每个句子的前 length 个。
         返回 [用 RNN 来扫描的span 数量，max_span_len, dim]
         """
         batch_size, time_steps, size = inputs.size()
-        zero_pad = torch.zeros(self.max_span_len, size, device=inputs.device)
-        batch_b2e_sub_inputs = []
-        batch_e2b_sub_inputs = []
-        for it_id, it_input in enumerate(inputs):
-            it_len = lengths[it_id]
-            b2e_input = torch.cat(
-                [it_input.index_select(0, torch.tensor(list(range(it_len)), device=inputs.device)), zero_pad])
-            b2e_sub_inputs = torch.stack([b2e_input[i: i + self.max_span_len] for i in range(it_len)])
-            e2b_input = torch.cat(
-                [it_input.index_select(0, torch.tensor(list(reversed(range(it_len))), device=inputs.device)), zero_pad])
-            e2b_sub_inputs = torch.stack([e2b_input[i: i + self.max_span_len] for i in range(it_len)])
-
-            batch_b2e_sub_inputs.append(b2e_sub_inputs)
-            batch_e2b_sub_inputs.append(e2b_sub_inputs)
-
-        batch_b2e_sub_inputs = torch.cat(batch_b2e_sub_inputs)
-        batch_e2b_sub_inputs = torch.cat(batch_e2b_sub_inputs)
-
-        return batch_b2e_sub_inputs, batch_e2b_sub_inputs
+        lens = torch.tensor(lengths, device=inputs.device)
+        steps = torch.arange(time_steps, device=inputs.device)
+        valid = steps.unsqueeze(0) < lens.unsqueeze(1)  # [batch_size, time_steps]
+        zero = inputs.new_zeros(())
 
-    def forward(self, inputs: torch.Tensor, lengths: list,
-                sos_repr=None, eos_repr=None):
+        b2e_input = torch.where(valid.unsqueeze(2), inputs, zero)
+        reversed_ids = (lens.unsqueeze(1) - 1 - steps.unsqueeze(0)).clamp(min=0)
+        e2b_input = torch.where(valid.unsqueeze(2),
+                                inputs.gather(1, reversed_ids.unsqueeze(2).expand(-1, -1, size)),
+                                zero)
+
+        zero_pad = inputs.new_zeros(batch_size, self.max_span_len, size)
+
+        def windows(seq_input):
+            # [batch_size, time_steps + 1, size, max_span_len] -> [span 数量, max_span_len, size]
+            seq_windows = torch.cat([seq_input, zero_pad], 1).unfold(1, self.max_span_len, 1)
+            return seq_windows[:, :time_steps].transpose(2, 3)[valid]
+
+        return windows(b2e_input), windows(e2b_input)
+
+    def enumerate_window_outputs(self, inputs, lengths, sos_repr=None, eos_repr=None):
+        """
+        用编码器扫描 enumerate_inputs 枚举的每个窗口，
+        返回按 gen_fragment_ids 的片段顺序排列的 [片段数量, dim] 的正向、反向输出
+        """
         b2e_sub_inputs, e2b_sub_inputs = self.enumerate_inputs(inputs, lengths)
         if sos_repr is not None:
             # print(b2e_sub_inputs.mean().item(), b2e_sub_inputs.std().item(),
@@ -53,31 +58,80 @@ class FragmentEnumerator(torch.nn.Module):
             e2b_sub_inputs = torch.cat((eos_repr.expand((e2b_sub_inputs.size(0), 1, -1)),
                                         e2b_sub_inputs), dim=1)
 
+        if isinstance(self.b2e_encoder, RNNSeqEncoder):
+            # 每个窗口只扫描句子内的部分（加上 SOS/EOS），跳过补 0 的位置
+            b2e_window_lens = torch.from_numpy(np.concatenate([
+                np.minimum(self.max_span_len, length - np.arange(length)) for length in lengths
+            ]))
+            e2b_window_lens = b2e_window_lens
+            if sos_repr is not None:
+                b2e_window_lens = b2e_window_lens + 1
+            if eos_repr is not None:
+                e2b_window_lens = e2b_window_lens + 1
+            b2e_encoder_args = (b2e_window_lens,)
+            e2b_encoder_args = (e2b_window_lens,)
+        else:
+            b2e_encoder_args, e2b_encoder_args = (), ()
+
         # flatten 成 [RNN 数量 * max_span_len， dim]
-        b2e_sub_outputs = self.b2e_encoder(b2e_sub_inputs)
+        b2e_sub_outputs = self.b2e_encoder(b2e_sub_inputs, *b2e_encoder_args)
         if sos_repr is not None:
             b2e_sub_outputs = b2e_sub_outputs[:, 1:, :]
         b2e_sub_outputs = b2e_sub_outputs.contiguous().view(-1, b2e_sub_outputs.size(2))
 
-        e2b_sub_outputs = self.e2b_encoder(e2b_sub_inputs)
+        e2b_sub_outputs = self.e2b_encoder(e2b_sub_inputs, *e2b_encoder_args)
         if eos_repr is not None:
             e2b_sub_outputs = e2b_sub_outputs[:, 1:, :]
         e2b_sub_outputs = e2b_sub_outputs.contiguous().view(-1, e2b_sub_outputs.size(2))
 
-        b2e_ids, e2b_ids = gen_fragment_ids(lengths, self.max_span_len)
+        b2e_ids, e2b_ids = fragment_id_tensors(tuple(lengths), self.max_span_len, inputs.device)
+
+        b2e_fragments = b2e_sub_outputs.index_select(0, b2e_ids)
+        e2b_fragments = e2b_sub_outputs.index_select(0, e2b_ids)
+        return b2e_fragments, e2b_fragments
+
+    def enumerate_linear_outputs(self, inputs, lengths, sos_repr=None, eos_repr=None):
+        """
+        FOFE、Average 这类线性递推的编码器不需要枚举窗口，所有片段的输出共递推 max_span_len 步：
+            正向：以 i 开始、长度为 j + 1 的片段 = step(以 i 开始、长度为 j 的片段, x[i + j])
+            反向：以 i 开始、长度为 j + 1 的片段 = step(以 i + 1 开始、长度为 j 的片段, x[i])
+        每一步的运算与逐个窗口扫描时相同，因此输出也相同。
+        返回按 gen_fragment_ids 的片段顺序排列的 [片段数量, dim] 的正向、反向输出
+        """
+        batch_size, time_steps, size = inputs.size()
+        lens = torch.tensor(lengths, device=inputs.device)
+        span_ids = torch.arange(self.max_span_len, device=inputs.device)
+        steps = torch.arange(time_steps, device=inputs.device)
+        # [batch_size, time_steps, max_span_len]
+        valid = (steps.view(1, -1, 1) + span_ids.view(1, 1, -1)) < lens.view(-1, 1, 1)
+
+        def span_outputs(encoder, start_repr, backward):
+            output = inputs.new_zeros(batch_size, time_steps, size)
+            t = 0
+            if start_repr is not None:
+                output = encoder.step(output, t, start_repr.expand_as(output))
+                t = 1
+            outputs = []
+            for j in range(self.max_span_len):
+                if backward:
+                    if j > 0:
+                        output = torch.cat([output[:, 1:], output.new_zeros(batch_size, 1, size)], 1)
+                    output = encoder.step(output, t + j, inputs)
+                else:
+                    t_input = torch.cat([inputs[:, j:], inputs.new_zeros(batch_size, min(j, time_steps), size)], 1)
+                    output = encoder.step(output, t + j, t_input)
+                outputs.append(output)
+            return torch.stack(outputs, 2)[valid]
 
-        b2e_fragments = b2e_sub_outputs.index_select(0, torch.tensor(b2e_ids, device=inputs.device))
-        e2b_fragments = e2b_sub_outputs.index_select(0, torch.tensor(e2b_ids, device=inputs.device))
+        return span_outputs(self.b2e_encoder, sos_repr, backward=False), \
+               span_outputs(self.e2b_encoder, eos_repr, backward=True)
 
-        # check size
-        row_num = 0
-        for length in lengths:
-            if length < self.max_span_len:
-                row_num += (1 + length) * length / 2
-            else:
-                row_num += (length + length - self.max_span_len + 1) \
-                           * self.max_span_len / 2
-        assert row_num == b2e_fragments.size(0)
+    def forward(self, inputs: torch.Tensor, lengths: list,
+                sos_repr=None, eos_repr=None):
+        if isinstance(self.b2e_encoder, (FofeSeqEncoder, AverageSeqEncoder)):
+            b2e_fragments, e2b_fragments = self.enumerate_linear_outputs(inputs, lengths, sos_repr, eos_repr)
+        else:
+            b2e_fragments, e2b_fragments = self.enumerate_window_outputs(inputs, lengths, sos_repr, eos_repr)
 
         if self.fusion == 'cat':
             fragments = torch.cat([b2e_fragments, e2b_fragments], 1)
@@ -86,3 +140,39 @@ class FragmentEnumerator(torch.nn.Module):
         else:
             return Exception
         return fragments
+
+
+class BoundaryEnumerator(torch.nn.Module):
+    """
+    不扫描窗口，由片段两端的 token 表示构造片段表示：
+        [h_b; h_e; h_e - h_b; h_b * h_e; width_emb(e - b)] 经过线性变换，
+    fusion 为 cat 时输出 2 * input_size 维，为 add 时输出 input_size 维，与 FragmentEnumerator 相同。
+    """
+
+    def __init__(self,
+                 max_span_len,
+                 input_size,
+                 width_emb_size,
+                 fusion='cat'):
+        super(BoundaryEnumerator, self).__init__()
+        self.max_span_len = max_span_len
+        # dense, so not named *embeds which are optimized by SparseAdam
+        self.width_embedding = torch.nn.Embedding(max_span_len, width_emb_size)
+        if fusion == 'cat':
+            out_size = 2 * input_size
+        elif fusion == 'add':
+            out_size = input_size
+        else:
+            raise Exception
+        self.projection = torch.nn.Linear(4 * input_size + width_emb_size, out_size)
+
+    def forward(self, inputs: torch.Tensor, lengths: list,
+                sos_repr=None, eos_repr=None):
+        # sos_repr/eos_repr 只用于扫描窗口的编码器
+        b_ids, e_ids, widths = boundary_id_tensors(tuple(lengths), self.max_span_len, inputs.device)
+        flat_inputs = inputs.contiguous().view(-1, inputs.size(2))
+        b_reprs = flat_inputs.index_select(0, b_ids)
+        e_reprs = flat_inputs.index_select(0, e_ids)
+        fragments = torch.cat([b_reprs, e_reprs, e_reprs - b_reprs, b_reprs * e_reprs,
+                               self.width_embedding(widths)], 1)
+        return self.projection(fragments)
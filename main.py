@@ -6,9 +6,10 @@ import torch
 from buff import focal_loss, group_fields
 import torch.nn.functional as F
 from functools import lru_cache
-from dataset import ConllDataSet, gen_lexicon_vocab, load_vocab, gen_vocab, usable_data_sets, match2idx_naive
+from dataset import ConllDataSet, StreamingConllDataSet, gen_lexicon_vocab, load_vocab, gen_vocab, usable_data_sets, match2idx_naive
 from program_args import config
-from model import Luban7, gen_word2vec_name_dim
+from model import Luban7
+from batch_loader import prefetch_batches
 from evaluation import CRFEvaluator, LubanEvaluator, LubanSpan, luban_span_to_str
 import pdb
 
@@ -26,6 +27,18 @@ def enum_span_by_length(text_len):
     return span_lst
 
 
+def next_batch(data_set, batch_size, fill_batch=True):
+    """
+    With config.span_budget > 0, a batch of a ConllDataSet is cut by the number
+    of fragments it enumerates instead of the number of sentences.
+    """
+    if config.span_budget > 0 and isinstance(data_set, ConllDataSet):
+        return data_set.next_batch_by_budget(
+            config.span_budget,
+            data_set.span_costs(with_matches=config.span_budget_type == "match"))
+    return data_set.next_batch(batch_size, fill_batch=fill_batch)
+
+
 ###################################################################
 # Main
 ###################################################################
@@ -35,17 +48,14 @@ def main():
     for key, value in config.__dict__.items():
         log("\t--{}={}".format(key, value))
     used_data_set = usable_data_sets[config.use_data_set]
-    lex_vec_name, _ = gen_word2vec_name_dim(config.lexicon_emb_pretrain)
-    char_emb_name, _ = gen_word2vec_name_dim(config.char_emb_pretrain)
-    model_folder = "saved/{}.{}.{}.{}.{}.{}.{}.{}.{}.{}".format(
-        config.use_data_set, config.match_mode,
-        config.max_sentence_length, config.max_span_length, config.max_match_num,
-        char_emb_name, lex_vec_name,
-        config.char_count_gt, config.bichar_count_gt, config.pos_bmes
-    )
-    set_saved_path(model_folder)
-
-    vocab_folder = "{}/vocab".format(model_folder)
+    # every cached artifact is keyed by the files and the config fields it is built from
+    set_saved_path("saved/cache")
+
+    vocab_folder = "saved/cache/{}".format(cache_key(
+        "vocab", used_data_set[0],
+        char_count_gt=config.char_count_gt,
+        bichar_count_gt=config.bichar_count_gt,
+        pos_bmes=config.pos_bmes))
     gen_vocab(data_path=used_data_set[0],
               out_folder=vocab_folder,
               char_count_gt=config.char_count_gt,
@@ -53,9 +63,12 @@ def main():
               use_cache=config.load_from_cache == "on",
               ignore_tag_bmes=config.pos_bmes == 'off')
     if config.lexicon_emb_pretrain != "off":
+        lexicon_folder = "saved/cache/{}".format(cache_key(
+            "lexicon", *used_data_set, config.lexicon_emb_pretrain,
+            max_span_length=config.max_span_length))
         gen_lexicon_vocab(*used_data_set,
                           word2vec_path=config.lexicon_emb_pretrain,
-                          out_folder=vocab_folder,
+                          out_folder=lexicon_folder,
                           use_cache=config.load_from_cache == "on")
 
     char2idx, idx2char = load_vocab("{}/char.vocab".format(vocab_folder))
@@ -65,14 +78,22 @@ def main():
     ner2idx, idx2ner = load_vocab("{}/ner.vocab".format(vocab_folder))
     label2idx, idx2label = load_vocab("{}/label.vocab".format(vocab_folder))
     if config.lexicon_emb_pretrain != "off":
-        lexicon2idx, idx2lexicon = load_vocab("{}/lexicon.vocab".format(vocab_folder))
+        lexicon2idx, idx2lexicon = load_vocab("{}/lexicon.vocab".format(lexicon_folder))
     else:
         lexicon2idx, idx2lexicon = None, None
 
     idx2str = lambda idx_lst: "".join(map(lambda x: idx2char[x], idx_lst))
-    train_set = auto_create(
-        "train_set",
-        lambda: ConllDataSet(
+    vocab_paths = ["{}/{}".format(vocab_folder, vocab_file) for vocab_file in sorted(os.listdir(vocab_folder))]
+    if config.lexicon_emb_pretrain != "off":
+        vocab_paths.append("{}/lexicon.vocab".format(lexicon_folder))
+    dataset_fields = dict(max_sentence_length=config.max_sentence_length,
+                          pos_bmes=config.pos_bmes,
+                          use_lexicon=config.lexicon_emb_pretrain != "off",
+                          match_mode=config.match_mode,
+                          max_span_length=config.max_span_length,
+                          max_match_num=config.max_match_num)
+    if config.stream_train == "on":
+        train_set = StreamingConllDataSet(
             data_path=used_data_set[0],
             lexicon2idx=lexicon2idx,
             char2idx=char2idx, bichar2idx=bichar2idx, seg2idx=seg2idx,
@@ -80,9 +101,26 @@ def main():
             ignore_pos_bmes=config.pos_bmes == 'off',
             max_text_len=config.max_sentence_length,
             max_span_len=config.max_span_length,
-            sort_by_length=True), cache=config.load_from_cache == "on")  # type: ConllDataSet
+            shuffle_buffer=config.shuffle_buffer)
+    else:
+        train_set = auto_create(
+            cache_key("train_set", used_data_set[0], *vocab_paths, **dataset_fields),
+            lambda: ConllDataSet(
+                data_path=used_data_set[0],
+                lexicon2idx=lexicon2idx,
+                char2idx=char2idx, bichar2idx=bichar2idx, seg2idx=seg2idx,
+                pos2idx=pos2idx, ner2idx=ner2idx, label2idx=label2idx,
+                ignore_pos_bmes=config.pos_bmes == 'off',
+                max_text_len=config.max_sentence_length,
+                max_span_len=config.max_span_length,
+                sort_by_length=True,
+                num_workers=config.data_num_workers,
+                chunk_size=config.data_chunk_size),
+            cache=config.load_from_cache == "on",
+            fingerprint=file_fingerprint(used_data_set[0], *vocab_paths, **dataset_fields),
+            array_cls=ConllDataSet)  # type: ConllDataSet
     dev_set = auto_create(
-        "dev_set",
+        cache_key("dev_set", used_data_set[1], *vocab_paths, **dataset_fields),
         lambda: ConllDataSet(
             data_path=used_data_set[1],
             lexicon2idx=lexicon2idx,
@@ -91,9 +129,14 @@ def main():
             max_text_len=config.max_sentence_length,
             # max_span_len=config.max_span_length,
             ignore_pos_bmes=config.pos_bmes == 'off',
-            sort_by_length=False), cache=config.load_from_cache == "on")  # type: ConllDataSet
+            sort_by_length=False,
+            num_workers=config.data_num_workers,
+            chunk_size=config.data_chunk_size),
+        cache=config.load_from_cache == "on",
+        fingerprint=file_fingerprint(used_data_set[1], *vocab_paths, **dataset_fields),
+        array_cls=ConllDataSet)  # type: ConllDataSet
     test_set = auto_create(
-        "test_set",
+        cache_key("test_set", used_data_set[2], *vocab_paths, **dataset_fields),
         lambda: ConllDataSet(
             data_path=used_data_set[2],
             lexicon2idx=lexicon2idx,
@@ -102,7 +145,12 @@ def main():
             max_text_len=config.max_sentence_length,
             # max_span_len=config.max_span_length,
             ignore_pos_bmes=config.pos_bmes == 'off',
-            sort_by_length=False), cache=config.load_from_cache == "on")  # type: ConllDataSet
+            sort_by_length=False,
+            num_workers=config.data_num_workers,
+            chunk_size=config.data_chunk_size),
+        cache=config.load_from_cache == "on",
+        fingerprint=file_fingerprint(used_data_set[2], *vocab_paths, **dataset_fields),
+        array_cls=ConllDataSet)  # type: ConllDataSet
     longest_span_len = max(train_set.longest_span_len, dev_set.longest_span_len)
     longest_text_len = max(train_set.longest_text_len, dev_set.longest_text_len)
 
@@ -172,24 +220,37 @@ def main():
         if config.train_on == "on":
             log(">>> epoch {} train".format(epoch_id))
             luban7.train()
-            train_set.reset(shuffle=True)
+            train_set.reset(shuffle=True,
+                            bucket_batch_size=config.batch_size if config.bucket_batch == "on" else 0)
             iter_id = 0
             progress = ProgressManager(total=train_set.size)
             log(train_set.size)
-            while not train_set.finished:
+            if isinstance(train_set, ConllDataSet):
+                log("padding waste: {:.4f}".format(train_set.padding_waste(
+                    config.batch_size, config.span_budget, config.span_budget_type == "match")))
+            for batch in prefetch_batches(train_set,
+                                          lambda: next_batch(train_set, config.batch_size),
+                                          luban7.make_batch,
+                                          depth=config.prefetch_depth):
                 iter_id += 1
-                batch_data = train_set.next_batch(config.batch_size)
-                batch_data = sorted(batch_data, key=lambda x: len(x[0]), reverse=True)
+                batch_data = batch.data
+                crf_decode = config.crf != 0.0 and config.crf_train_decode > 0 \
+                             and iter_id % config.crf_train_decode == 0
+                outputs = luban7(batch,
+                                 crf_loss=config.crf != 0.0,
+                                 crf_decode=crf_decode,
+                                 span_score=config.crf != 1.0)
 
                 # >>> CRF
                 if config.crf == 0.0:
                     crf_loss = 0.0
                     crf_log = "no crf"
                 else:
-                    crf_loss = luban7.crf_nll(batch_data)
-                    crf_f1 = crf_evaluator.eval(luban7.crf_decode(batch_data),
-                                                group_fields(batch_data, "ners"))[2]
-                    crf_log = "crf loss: {:.4f} f1: {:.4f} ".format(crf_loss.item(), crf_f1)
+                    crf_loss = outputs.crf_loss
+                    crf_log = "crf loss: {:.4f} ".format(crf_loss.item())
+                    if crf_decode:
+                        crf_f1 = crf_evaluator.eval(outputs.crf_tags, group_fields(batch_data, "ners"))[2]
+                        crf_log += "f1: {:.4f} ".format(crf_f1)
                 # <<< CRF
 
                 # >>> Luban
@@ -197,12 +258,12 @@ def main():
                     luban_loss = 0
                     luban_log = "no luban"
                 else:
-                    score, span_ys = luban7.get_span_score_tags(batch_data)
+                    score, span_ys = outputs.span_score, outputs.span_ys
                     luban_loss = focal_loss(inputs=score,
-                                            targets=torch.tensor(span_ys, device=device),
+                                            targets=span_ys,
                                             gamma=config.focal_gamma)
                     score_probs = F.softmax(score, dim=1)
-                    luban_precision = accuracy(score_probs.detach().cpu().numpy(), span_ys)
+                    luban_precision = accuracy(score_probs.detach().cpu().numpy(), span_ys.tolist())
                     luban_log = "luban loss: {:.4f} precision: {:.4f}".format(luban_loss.item(), luban_precision)
                 # <<< Luban
 
@@ -249,28 +310,31 @@ def main():
 
                 set_for_validation.reset(shuffle=False)
                 progress = ProgressManager(total=set_for_validation.size)
-                while not set_for_validation.finished:
-                    batch_data = set_for_validation.next_batch(10, fill_batch=True)
-                    batch_data = sorted(batch_data, key=lambda x: len(x[0]), reverse=True)  # type: List[Datum]
-
-                    texts = list(map(lambda x: x[0], batch_data))
-                    text_lens = batch_lens(texts)
+                for batch in prefetch_batches(set_for_validation,
+                                              lambda: next_batch(set_for_validation, 10, fill_batch=True),
+                                              luban7.make_batch,
+                                              depth=config.prefetch_depth):
+                    batch_data = batch.data  # type: List[Datum]
+                    text_lens = batch.text_lens
 
                     print(">>> text ", text_lens)
 
+                    outputs = luban7(batch,
+                                     crf_loss=False,
+                                     crf_decode=config.crf != 0.0,
+                                     span_score=config.crf != 1.0,
+                                     lex_att=config.show_att == "on")
+
                     # >>> CRF
                     if config.crf != 0.0:
-                        results = luban7.crf_decode(batch_data)
-                        crf_evaluator.eval(results, group_fields(batch_data, "ners"))
+                        crf_evaluator.eval(outputs.crf_tags, group_fields(batch_data, "ners"))
 
                     # <<< CRF
 
                     # >>> Luban
                     if config.crf != 1.0:
-                        if config.show_att == "on":
-                            score, span_ys, lex_att_score = luban7.get_span_score_tags(batch_data, True)
-                        else:
-                            score, span_ys = luban7.get_span_score_tags(batch_data, False)
+                        score, span_ys, lex_att_score = outputs.span_score, outputs.span_ys, outputs.lex_att_score
+                        span_ys = span_ys.tolist()
                         score_probs = F.softmax(score, dim=1)
 
                         for ts_id, threshold in enumerate(thresholds):
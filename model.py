@@ -1,17 +1,18 @@
 from buff import *
 from typing import NamedTuple
 import torch
-from buff import focal_loss, group_fields
+from buff import focal_loss
 import math
-from frag_enumerator import FragmentEnumerator
+from frag_enumerator import FragmentEnumerator, BoundaryEnumerator
 from context_enumerator import ContextEnumerator
 from seq_encoder import RNNSeqEncoder, FofeSeqEncoder, AverageSeqEncoder
 from transformer import TransformerEncoderV2, PositionWiseFeedForward
 from functools import lru_cache
-from dataset import Sp, match2idx_naive, match2idx_middle, match2idx_mix, max_match_num
+from dataset import match2idx_naive, match2idx_middle, match2idx_mix, max_match_num
 from token_encoder import BiRNNTokenEncoder, MixEmbedding
 from attention import MultiHeadAttention, gen_att_mask, VanillaAttention
 from torch_crf import CRF
+from batch_loader import Batch, BatchBuilder, batch_to
 from program_args import config
 
 
@@ -22,6 +23,13 @@ def gen_word2vec_name_dim(word2vec_pretrain):
     return found.group(1), int(found.group(2))
 
 
+LubanOutputs = NamedTuple("LubanOutputs", [("crf_loss", torch.Tensor),
+                                           ("crf_tags", List[List[int]]),
+                                           ("span_score", torch.Tensor),
+                                           ("span_ys", torch.Tensor),
+                                           ("lex_att_score", torch.Tensor)])
+
+
 class Luban7(torch.nn.Module):
 
     def __init__(self,
@@ -37,6 +45,7 @@ class Luban7(torch.nn.Module):
         self.label2idx = label2idx
         self.pos2idx = pos2idx
         self.lexicon2idx = lexicon2idx
+        self.batch_builder = BatchBuilder(char2idx, bichar2idx, seg2idx, pos2idx)
 
         """ Embedding Layer """
         self.embeds = MixEmbedding(char_vocab_size=len(char2idx),
@@ -56,14 +65,18 @@ class Luban7(torch.nn.Module):
                           word2vec_path=config.char_emb_pretrain,
                           norm=True,
                           word_dict=self.char2idx,
-                          cached_name="char" if config.load_from_cache == "on" else None
+                          cached_name="char" if config.load_from_cache == "on" else None,
+                          use_store=config.word2vec_store == "on",
+                          num_workers=config.word2vec_num_workers
                           )
         if config.bichar_emb_size > 0 and config.bichar_emb_pretrain != 'off':
             load_word2vec(embedding=self.embeds.bichar_embeds,
                           word2vec_path=config.bichar_emb_pretrain,
                           norm=True,
                           word_dict=self.bichar2idx,
-                          cached_name="bichar" if config.load_from_cache == "on" else None
+                          cached_name="bichar" if config.load_from_cache == "on" else None,
+                          use_store=config.word2vec_store == "on",
+                          num_workers=config.word2vec_num_workers
                           )
         self.embeds.show_mean_std()
 
@@ -98,7 +111,7 @@ class Luban7(torch.nn.Module):
             torch.nn.ReLU(),
             torch.nn.Linear(token_dim * 2, len(ner2idx)),
         )
-        self.ner_crf = CRF(len(ner2idx), batch_first=True)
+        self.ner_crf = CRF(len(ner2idx), batch_first=True, parallel_scan=config.crf_scan == "on")
 
         """ Fragment & Context Layer"""
         frag_dim = 0
@@ -123,6 +136,13 @@ class Luban7(torch.nn.Module):
                 encoder_args=(),
                 fusion=config.frag_fusion
             )
+        elif config.frag_type == "boundary":
+            self.fragment_encoder = BoundaryEnumerator(
+                max_span_len=config.max_span_length,
+                input_size=token_dim,
+                width_emb_size=config.frag_width_emb_size,
+                fusion=config.frag_fusion
+            )
         elif config.frag_type == "off":
             pass
         else:
@@ -187,7 +207,9 @@ class Luban7(torch.nn.Module):
                 config.lexicon_emb_pretrain,
                 norm=True,
                 cached_name="lexicon".format(lexicon_emb_name)
-                if config.load_from_cache == "on" else None
+                if config.load_from_cache == "on" else None,
+                use_store=config.word2vec_store == "on",
+                num_workers=config.word2vec_num_workers
             )
             if config.match_mode in ["naive", "mix", "middle"]:
                 if config.match_mode == "naive":
@@ -239,78 +261,72 @@ class Luban7(torch.nn.Module):
     def device(self):
         return next(self.parameters()).device
 
-    def gen_span_ys(self, texts, labels):
-        text_lens = batch_lens(texts)
-        span_ys = []
-        for bid in range(len(texts)):
-            for begin_token_idx in range(text_lens[bid]):
-                for span_len in range(1, config.max_span_length + 1):
-                    end_token_idx = begin_token_idx + span_len - 1
-                    if end_token_idx < text_lens[bid]:
-                        has_label = False
-                        for span in labels[bid]:
-                            if span.b == begin_token_idx and span.e == end_token_idx:
-                                span_ys.append(span.y)
-                                has_label = True
-                                break
-                        if not has_label:
-                            span_ys.append(0)
-                        # log(begin_token_idx, ", ", end_token_idx, " of ", text_lens[bid])
-        return span_ys
-
-    def compute_token_reprs(self, batch_data):
-        chars, bichars, segs, poss = group_fields(
-            batch_data,
-            keys=["chars", "bichars", "segs", "poss"]
-        )
-        text_lens = batch_lens(chars)
-
-        pad_chars = batch_pad(chars, self.char2idx[Sp.pad])
-        pad_bichars = batch_pad(bichars, self.bichar2idx[Sp.pad])
-        pad_segs = batch_pad(segs, self.seg2idx[Sp.pad])
-        pad_poss = batch_pad(poss, self.pos2idx[Sp.pad])
-
-        pad_chars_tensor = torch.tensor(pad_chars, device=self.device)
-        pad_bichars_tensor = torch.tensor(pad_bichars, device=self.device)
-        pad_segs_tensor = torch.tensor(pad_segs, device=self.device)
-        pad_poss_tensor = torch.tensor(pad_poss, device=self.device)
+    def make_batch(self, batch_data) -> Batch:
+        """ Padded tensors of a list of Datum, moved to the model's device. """
+        if not isinstance(batch_data, Batch):
+            batch_data = self.batch_builder(batch_data)
+        return batch_to(batch_data, self.device)
 
-        input_embs = self.embeds(pad_chars_tensor,
-                                 pad_bichars_tensor,
-                                 pad_segs_tensor,
-                                 pad_poss_tensor)
+    def compute_token_reprs(self, batch: Batch):
+        input_embs = self.embeds(batch.chars,
+                                 batch.bichars,
+                                 batch.segs,
+                                 batch.poss)
 
         if config.token_type == 'rnn':
-            token_reprs = self.token_encoder(input_embs, text_lens)
+            token_reprs = self.token_encoder(input_embs, batch.text_lens)
         elif config.token_type == 'tfer':
-            masks = self.token_encoder.gen_masks(pad_chars_tensor)
-            token_reprs = self.token_encoder(input_embs, masks, text_lens)
+            masks = self.token_encoder.gen_masks(batch.chars)
+            token_reprs = self.token_encoder(input_embs, masks, batch.text_lens)
         else:
             token_reprs = input_embs
         return token_reprs
 
-    def crf_nll(self, batch_data) -> torch.Tensor:
-        gold_tags = group_fields(batch_data, keys="ners")
-        token_reprs = self.compute_token_reprs(batch_data)
+    def forward(self, batch_data, crf_loss=True, crf_decode=False, span_score=True, lex_att=False) -> LubanOutputs:
+        """
+        Compute the token representations of a batch once, and from them the
+        CRF loss, the CRF decoded tags and the span scores that are asked for.
+        The others are None.
+        """
+        batch = self.make_batch(batch_data)
+        token_reprs = self.compute_token_reprs(batch)
+        outputs = LubanOutputs(None, None, None, None, None)
+        if crf_loss:
+            outputs = outputs._replace(crf_loss=self.crf_nll(batch, token_reprs))
+        if crf_decode:
+            outputs = outputs._replace(crf_tags=self.crf_decode(batch, token_reprs))
+        if span_score:
+            span_outputs = self.get_span_score_tags(batch, lex_att, token_reprs)
+            outputs = outputs._replace(**dict(zip(["span_score", "span_ys", "lex_att_score"], span_outputs)))
+        return outputs
+
+    def crf_nll(self, batch_data, token_reprs=None) -> torch.Tensor:
+        batch = self.make_batch(batch_data)
+        if token_reprs is None:
+            token_reprs = self.compute_token_reprs(batch)
         scores = self.ner_score(token_reprs)
-        gold_tags = torch.tensor(batch_pad(gold_tags, 0))
-        masks = torch.tensor(batch_mask(gold_tags, mask_zero=True), dtype=torch.uint8, device=self.device)
-        crf_loss = self.ner_crf(scores, gold_tags, masks, reduction="mean")
+        # the padded tags are scored as well
+        masks = torch.ones_like(batch.ners, dtype=torch.uint8)
+        crf_loss = self.ner_crf(scores, batch.ners, masks, reduction="mean")
         return - crf_loss
 
-    def crf_decode(self, batch_data) -> List[List[int]]:
-        chars = group_fields(batch_data, keys="chars")
-        token_reprs = self.compute_token_reprs(batch_data)
+    def crf_decode(self, batch_data, token_reprs=None) -> List[List[int]]:
+        batch = self.make_batch(batch_data)
+        if token_reprs is None:
+            token_reprs = self.compute_token_reprs(batch)
         scores = self.ner_score(token_reprs)
-        masks = torch.tensor(batch_mask(chars, mask_zero=True), dtype=torch.uint8, device=self.device)
-        results = self.ner_crf.decode(scores, masks)
+        results = self.ner_crf.decode(scores, batch.text_masks)
         return results
 
-    def get_span_score_tags(self, batch_data, lex_att=False):
-        chars = group_fields(batch_data, keys='chars')
-        text_lens = batch_lens(chars)
-        labels = group_fields(batch_data, keys='labels')
-        token_reprs = self.compute_token_reprs(batch_data)
+    def get_span_score_tags(self, batch_data, lex_att=False, token_reprs=None):
+        """
+        Return the scores of the fragments of a batch and their gold labels as
+        a LongTensor on the model's device.
+        """
+        batch = self.make_batch(batch_data)
+        text_lens = batch.text_lens
+        if token_reprs is None:
+            token_reprs = self.compute_token_reprs(batch)
 
         if config.frag_type != "off":
             frag_reprs = self.fragment_encoder(token_reprs, text_lens,
@@ -319,19 +335,19 @@ class Luban7(torch.nn.Module):
             if config.frag_att_type != "off":
                 # print(Color.red("ATTENTION!"))
                 d_frag = frag_reprs.size(1)
-                att_frag_reprs = []
-                offset = 0
-                for i, text_len in enumerate(text_lens):
-                    q = frag_reprs[offset: offset + span_num(text_len)].unsqueeze(0)
-                    k = token_reprs[i][:text_len].unsqueeze(0)
-                    v = k
-                    mask = gen_att_mask(k_lens=(text_len,),
-                                        max_k_len=text_len, max_q_len=q.size(1),
-                                        device=self.device)
-                    att_frag_repr, att_score = self.multi_att(q, k, v, mask)
-                    att_frag_reprs.append(att_frag_repr.squeeze(0))
-                    offset += text_len
-                att_frag_reprs = torch.cat(att_frag_reprs)
+                # the fragments of each sentence attend to its tokens, padded to
+                # [batch_size, max fragment num, d_frag] and masked by text_lens
+                frag_nums = [span_num(text_len) for text_len in text_lens]
+                q = torch.nn.utils.rnn.pad_sequence(frag_reprs.split(frag_nums), batch_first=True)
+                k = token_reprs
+                v = k
+                mask = gen_att_mask(k_lens=text_lens,
+                                    max_k_len=k.size(1), max_q_len=q.size(1),
+                                    device=self.device)
+                att_frag_reprs, att_score = self.multi_att(q, k, v, mask)
+                frag_mask = torch.arange(q.size(1), device=self.device).unsqueeze(0) < \
+                            torch.tensor(frag_nums, device=self.device).unsqueeze(1)
+                att_frag_reprs = att_frag_reprs[frag_mask]
 
                 att_frag_reprs = self.att_norm(att_frag_reprs) / math.sqrt(d_frag)
                 # show_mean_std(frag_reprs)
@@ -358,39 +374,34 @@ class Luban7(torch.nn.Module):
 
         if config.lexicon_emb_pretrain != "off":
             if config.match_mode in ["naive", "middle", "mix"]:
-                lexmatches = group_fields(batch_data, keys='lexmatches')
-                lexmatches = [item[1] for sublist in lexmatches for item in sublist]
-                assert len(lexmatches) == frag_reprs.size(0)
-                frag_match_lexicons, frag_match_types = [], []
-                for it_match in lexmatches:
-                    if len(it_match) == 0:
-                        frag_match_lexicons.append([])
-                        frag_match_types.append([])
-                    else:
-                        frag_match_lexicons.append(group_fields(it_match, indices=0))
-                        frag_match_types.append(group_fields(it_match, indices=1))
-
-                mask = gen_att_mask(batch_lens(frag_match_lexicons), max_match_num, 1).to(self.device)
-                frag_match_lexicons = batch_pad(frag_match_lexicons, pad_len=max_match_num)
-                frag_match_types = batch_pad(frag_match_types, pad_len=max_match_num)
-                frag_match_lexicons = torch.tensor(frag_match_lexicons, dtype=torch.long, device=self.device)
-                frag_match_types = torch.tensor(frag_match_types, dtype=torch.long, device=self.device)
-                mem_lexicon = self.lexicon_embeds(frag_match_lexicons)
-                mem_match = self.match_embeds(frag_match_types)
-                memory = torch.cat([mem_lexicon, mem_match], dim=2)
+                assert batch.span_ys.size(0) == frag_reprs.size(0)
+                # only the real matches of the fragments are in the memory, as a flat list,
+                # embedded and projected once per distinct (lexicon, type) pair of the batch
+                mem_lexicon = self.lexicon_embeds(batch.match_lexicons)
+                mem_match = self.match_embeds(batch.match_types)
+                memory = torch.cat([mem_lexicon, mem_match], dim=1)
+                ragged_args = (batch.match_frag_ids, batch.match_slot_ids, max_match_num, batch.match_memory_ids)
                 if config.match_head == 0:
-                    att_word, lex_att_score = self.lexicon_attention(frag_reprs.unsqueeze(1), memory, mask)
+                    att_word, lex_att_score = self.lexicon_attention.forward_ragged(frag_reprs, memory,
+                                                                                    *ragged_args)
                 elif config.match_head > 0:
-                    att_word, lex_att_score = self.lexicon_attention(frag_reprs.unsqueeze(1), memory, memory, mask)
+                    att_word, lex_att_score = self.lexicon_attention.forward_ragged(frag_reprs, memory, memory,
+                                                                                    *ragged_args)
+                    lex_att_score = lex_att_score[:, 0]
                 else:
                     raise Exception
-                frag_reprs = torch.cat([frag_reprs, att_word.squeeze(1)], dim=1)
+                if lex_att:
+                    # [num_frags, 1, max_match_num] as the padded attention, of the first head
+                    lex_att_table = lex_att_score.new_zeros(frag_reprs.size(0), max_match_num)
+                    lex_att_table[batch.match_frag_ids, batch.match_slot_ids] = lex_att_score
+                    lex_att_score = lex_att_table.unsqueeze(1)
+                frag_reprs = torch.cat([frag_reprs, att_word], dim=1)
             elif config.match_mode == "off":
                 pass
             else:
                 raise Exception
 
-        span_ys = self.gen_span_ys(chars, labels)
+        span_ys = batch.span_ys
         # score = frag_reprs @ self.label_weight + self.label_bias
         score = self.scorer(frag_reprs)
         if lex_att:
@@ -13,6 +13,8 @@ class ProgramArgs(argparse.Namespace):
         self.token_type = "rnn"
 
         self.crf = 0.0
+        self.crf_train_decode = 1  # decode every n-th train batch to log the crf f1, 0: never
+        self.crf_scan = "off"  # on: the crf normalizer and viterbi by a parallel scan over the timesteps
 
         self.opt_type = "adam"
         self.lr = 0.001
@@ -43,10 +45,11 @@ class ProgramArgs(argparse.Namespace):
         self.rnn_hidden = 256
 
         # fragment encoder
-        self.frag_type = "rnn"
+        self.frag_type = "rnn"  # rnn | fofe | average | boundary | off
         self.frag_fusion = 'cat'
         self.frag_fofe_alpha = 0.5
         self.frag_use_sos = "on"
+        self.frag_width_emb_size = 32  # span width embedding of the boundary fragment encoder
 
         # fragment attention
         self.frag_att_type = 'off'
@@ -70,6 +73,8 @@ class ProgramArgs(argparse.Namespace):
         # self.lexicon_emb_pretrain = "word2vec/sgns/sgns_char.300.vec"
         # self.lexicon_emb_pretrain = "off"
         self.lexicon_emb_pretrain = "word2vec/lattice_lstm/ctb.50.vec"
+        self.word2vec_store = "off"  # on: gather vectors from a converted binary store; off: stream the .vec
+        self.word2vec_num_workers = 0  # processes parsing the .vec chunks, 0: parse in the main process
 
         # loss
         self.focal_gamma = 0
@@ -89,9 +94,17 @@ class ProgramArgs(argparse.Namespace):
         # development config
         self.max_match_num = 12
         self.batch_size = 32
+        self.bucket_batch = "off"  # on: batch the train sentences of similar lengths together
+        self.span_budget = 0  # > 0: batch by a budget of fragments instead of batch_size sentences
+        self.span_budget_type = "frag"  # frag: count fragments; match: count fragments * max_match_num
+        self.prefetch_depth = 0  # batches built ahead on a background thread, 0: build in the training loop
         self.epoch_fix_char_emb = 5
         self.epoch_fix_lexicon_emb = 5
         self.load_from_cache = "on"
+        self.data_num_workers = 0  # 0: build datasets in the main process
+        self.data_chunk_size = 1000
+        self.stream_train = "off"  # on: read and encode the train set lazily, for corpora larger than memory
+        self.shuffle_buffer = 10000
         self.train_on = "on"
         self.use_data_set = "resumethu"
         self.epoch_max = 30
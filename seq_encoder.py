@@ -16,6 +16,9 @@ class FofeSeqEncoder(BaseSeqEncoder):
         super(FofeSeqEncoder, self).__init__()
         self.alpha = alpha
 
+    def step(self, output, t, t_input):
+        return output * self.alpha + t_input
+
     def forward(self, inputs, batch_first=True):
         if batch_first:
             inputs = inputs.transpose(0, 1)
@@ -23,7 +26,7 @@ class FofeSeqEncoder(BaseSeqEncoder):
         output = torch.zeros(batch_size, size, device=inputs.device)
         outputs = []
         for t, t_input in enumerate(inputs):
-            output = output * self.alpha + t_input
+            output = self.step(output, t, t_input)
             outputs.append(output)
         outputs = torch.stack(outputs)
         if batch_first:
@@ -35,6 +38,9 @@ class AverageSeqEncoder(BaseSeqEncoder):
     def __init__(self):
         super(AverageSeqEncoder, self).__init__()
 
+    def step(self, output, t, t_input):
+        return (output * t + t_input) / (t + 1)
+
     def forward(self, inputs, batch_first=True):
         if batch_first:
             inputs = inputs.transpose(0, 1)
@@ -42,7 +48,7 @@ class AverageSeqEncoder(BaseSeqEncoder):
         output = torch.zeros(batch_size, size, device=inputs.device)
         outputs = []
         for t, t_input in enumerate(inputs):
-            output = (output * t + t_input) / (t + 1)
+            output = self.step(output, t, t_input)
             outputs.append(output)
         outputs = torch.stack(outputs)
         if batch_first:
@@ -64,6 +70,28 @@ class RNNSeqEncoder(BaseSeqEncoder):
         else:
             raise Exception('cell type not specified')
 
-    def forward(self, inputs):
-        outputs, _ = self.rnn(inputs)
-        return outputs
+    def forward(self, inputs, lengths=None):
+        """
+        With lengths (a LongTensor on cpu), the sequences of the same length run
+        together, truncated to that length, so no step is spent on the padding,
+        whose outputs are left as zeros. The rnn is causal, so the outputs of
+        the valid steps are the same as running the padded batch.
+        """
+        batch_size, time_steps, _ = inputs.size()
+        if lengths is None:
+            outputs, _ = self.rnn(inputs)
+            return outputs
+
+        group_outputs, group_ids = [], []
+        for length in torch.unique(lengths).tolist():
+            ids = torch.nonzero(lengths == length).view(-1)
+            outputs, _ = self.rnn(inputs.index_select(0, ids.to(inputs.device))[:, :length])
+            if length < time_steps:
+                outputs = torch.cat([outputs, outputs.new_zeros(outputs.size(0), time_steps - length,
+                                                                outputs.size(2))], 1)
+            group_outputs.append(outputs)
+            group_ids.append(ids)
+        if len(group_outputs) == 1:
+            return group_outputs[0]
+        restore_ids = torch.argsort(torch.cat(group_ids))
+        return torch.cat(group_outputs).index_select(0, restore_ids.to(inputs.device))
@@ -1,17 +1,17 @@
+from buff import read_word2vec_words
+
 vocab_path = "dataset/OntoNotes4/vocab.3.2/bichar.vocab"
 emb_path = "word2vec/lattice_lstm/gigauni.50.vec"
 
-embs = set()
-for line in open(emb_path, encoding="utf8"):
-    word = line.split(" ")[0]
-    # if "<s>" in word:
-    #     print(word)
-    embs.add(word)
-
 vocab = set()
 for line in open(vocab_path, encoding="utf8"):
     vocab.add(line.split(" ")[0])
 
+embs = set()
+for word in read_word2vec_words(emb_path):
+    if word in vocab:
+        embs.add(word)
+
 in_num = 0
 oov_num = 0
 for ele in vocab:
@@ -5,6 +5,21 @@ import torch.nn as nn
 
 # https://github.com/kmkurn/pytorch-crf
 
+# The "zero" of the semirings in the parallel scan, finite so that the gradients
+# of the log-sum-exp stay finite
+SCAN_NEG_INF = -10000.
+
+
+def log_matmul(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    # (..., n, k) x (..., k, m) in the log semiring
+    return torch.logsumexp(a.unsqueeze(-1) + b.unsqueeze(-3), dim=-2)
+
+
+def max_matmul(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    # (..., n, k) x (..., k, m) in the max-plus semiring
+    return (a.unsqueeze(-1) + b.unsqueeze(-3)).max(dim=-2)[0]
+
+
 class CRF(nn.Module):
     """Conditional random field.
 
@@ -19,6 +34,10 @@ class CRF(nn.Module):
         Number of tags.
     batch_first : bool, optional
         Whether the first dimension corresponds to the size of a minibatch.
+    parallel_scan : bool, optional
+        Whether to compute the normalizer and the Viterbi scores with a parallel
+        scan over the transition matrices of all timesteps, in O(log seq_length)
+        dependent steps rather than seq_length, at O(num_tags) times the work.
 
     Attributes
     ----------
@@ -39,12 +58,13 @@ class CRF(nn.Module):
     .. _Viterbi algorithm: https://en.wikipedia.org/wiki/Viterbi_algorithm
     """
 
-    def __init__(self, num_tags: int, batch_first: bool = False) -> None:
+    def __init__(self, num_tags: int, batch_first: bool = False, parallel_scan: bool = False) -> None:
         if num_tags <= 0:
             raise ValueError(f'invalid number of tags: {num_tags}')
         super().__init__()
         self.num_tags = num_tags
         self.batch_first = batch_first
+        self.parallel_scan = parallel_scan
         self.start_transitions = nn.Parameter(torch.empty(num_tags))
         self.end_transitions = nn.Parameter(torch.empty(num_tags))
         self.transitions = nn.Parameter(torch.empty(num_tags, num_tags))
@@ -62,7 +82,7 @@ class CRF(nn.Module):
         nn.init.uniform_(self.transitions, -0.1, 0.1)
 
     def __repr__(self) -> str:
-        return f'{self.__class__.__name__}(num_tags={self.num_tags})'
+        return f'{self.__class__.__name__}(num_tags={self.num_tags}, parallel_scan={self.parallel_scan})'
 
     def forward(
             self,
@@ -227,6 +247,9 @@ class CRF(nn.Module):
         assert emissions.size(2) == self.num_tags
         assert mask[0].all()
 
+        if self.parallel_scan:
+            return self._compute_normalizer_scan(emissions, mask)
+
         seq_length = emissions.size(0)
 
         # Start transition score and first emission; score has size of
@@ -278,6 +301,9 @@ class CRF(nn.Module):
         assert emissions.size(2) == self.num_tags
         assert mask[0].all()
 
+        if self.parallel_scan:
+            return self._viterbi_decode_scan(emissions, mask)
+
         seq_length, batch_size = mask.shape
 
         # Start transition and first emission
@@ -322,26 +348,99 @@ class CRF(nn.Module):
         # shape: (batch_size, num_tags)
         score += self.end_transitions
 
-        # Now, compute the best path for each sample
+        return self._backtrace(score, history, mask)
 
-        # shape: (batch_size,)
-        seq_ends = mask.long().sum(dim=0) - 1
-        best_tags_list = []
-
-        for idx in range(batch_size):
-            # Find the tag which maximizes the score at the last timestep; this is our best tag
-            # for the last timestep
-            _, best_last_tag = score[idx].max(dim=0)
-            best_tags = [best_last_tag.item()]
+    def _backtrace(self, score: torch.Tensor, history, mask: torch.ByteTensor) -> List[List[int]]:
+        # score: (batch_size, num_tags), with the end transition score
+        # history: (seq_length - 1, batch_size, num_tags), or a list of them
+        # mask: (seq_length, batch_size)
+        seq_length = mask.size(0)
 
-            # We trace back where the best last tag comes from, append that to our best tag
-            # sequence, and trace it back again, and so on
-            for hist in reversed(history[:seq_ends[idx]]):
-                best_last_tag = hist[idx][best_tags[-1]]
-                best_tags.append(best_last_tag.item())
+        # Now, compute the best path for all samples at once, on the device
 
-            # Reverse the order because we start from the last timestep
-            best_tags.reverse()
-            best_tags_list.append(best_tags)
+        # shape: (batch_size,)
+        seq_ends = mask.long().sum(dim=0) - 1
+        # Find the tag which maximizes the score at the last timestep; this is our best tag
+        # for the last timestep
+        # shape: (batch_size,)
+        _, best_last_tags = score.max(dim=1)
+
+        # We trace back where the best last tag comes from, and trace it back again, and so on.
+        # A sample starts at its own last timestep, steps past it are ignored
+        # shape: (seq_length, batch_size)
+        best_tags = torch.empty_like(mask, dtype=torch.long)
+        best_tag = best_last_tags
+        for i in range(seq_length - 1, -1, -1):
+            best_tag = torch.where(seq_ends == i, best_last_tags, best_tag)
+            best_tags[i] = best_tag
+            if i > 0:
+                best_tag = history[i - 1].gather(1, best_tag.unsqueeze(1)).squeeze(1)
+
+        best_tags = best_tags.t().tolist()
+        return [tags[:end + 1] for tags, end in zip(best_tags, seq_ends.tolist())]
+
+    def _step_matrices(self, emissions: torch.Tensor, mask: torch.ByteTensor) -> torch.Tensor:
+        # emissions: (seq_length, batch_size, num_tags)
+        # mask: (seq_length, batch_size)
+        # The score of transitioning from tag i to tag j and emitting j at timesteps
+        # 1..seq_length-1, the identity of the semirings where the timestep is masked
+        # shape: (seq_length - 1, batch_size, num_tags, num_tags)
+        step_scores = self.transitions + emissions[1:].unsqueeze(2)
+        identity = SCAN_NEG_INF * (1 - torch.eye(self.num_tags, dtype=emissions.dtype, device=emissions.device))
+        return torch.where(mask[1:].unsqueeze(2).unsqueeze(3), step_scores, identity)
+
+    @staticmethod
+    def _reduce(mats: torch.Tensor, matmul) -> torch.Tensor:
+        # The product of mats (n, ..., k, k) over the first dimension, as a tree
+        # shape: (..., k, k)
+        while mats.size(0) > 1:
+            if mats.size(0) % 2 == 1:
+                mats = torch.cat([matmul(mats[:-1:2], mats[1::2]), mats[-1:]], dim=0)
+            else:
+                mats = matmul(mats[0::2], mats[1::2])
+        return mats[0]
+
+    @staticmethod
+    def _scan(mats: torch.Tensor, matmul) -> torch.Tensor:
+        # The inclusive prefix products of mats (n, ..., k, k) over the first dimension
+        # shape: (n, ..., k, k)
+        step = 1
+        while step < mats.size(0):
+            mats = torch.cat([mats[:step], matmul(mats[:-step], mats[step:])], dim=0)
+            step *= 2
+        return mats
+
+    def _compute_normalizer_scan(
+            self, emissions: torch.Tensor, mask: torch.ByteTensor) -> torch.Tensor:
+        # emissions: (seq_length, batch_size, num_tags)
+        # mask: (seq_length, batch_size)
+        # shape: (batch_size, num_tags)
+        score = self.start_transitions + emissions[0]
+        if emissions.size(0) > 1:
+            # shape: (batch_size, num_tags, num_tags)
+            steps = self._reduce(self._step_matrices(emissions, mask), log_matmul)
+            # shape: (batch_size, num_tags)
+            score = log_matmul(score.unsqueeze(1), steps).squeeze(1)
+        score = score + self.end_transitions
+        return torch.logsumexp(score, dim=1)
 
-        return best_tags_list
+    def _viterbi_decode_scan(self, emissions: torch.FloatTensor,
+                             mask: torch.ByteTensor) -> List[List[int]]:
+        # emissions: (seq_length, batch_size, num_tags)
+        # mask: (seq_length, batch_size)
+        # The best scores of all timesteps come from the prefix products, the history
+        # is then computed from them for all timesteps at once as the sequential one
+        # shape: (batch_size, num_tags)
+        score = self.start_transitions + emissions[0]
+        history = []
+        if emissions.size(0) > 1:
+            # shape: (seq_length - 1, batch_size, num_tags, num_tags)
+            prefixes = self._scan(self._step_matrices(emissions, mask), max_matmul)
+            # shape: (seq_length, batch_size, num_tags)
+            scores = torch.cat([score.unsqueeze(0),
+                                max_matmul(score.unsqueeze(0).unsqueeze(2), prefixes).squeeze(2)], dim=0)
+            # shape: (seq_length - 1, batch_size, num_tags)
+            history = (scores[:-1].unsqueeze(3) + self.transitions + emissions[1:].unsqueeze(2)).max(dim=2)[1]
+            score = scores[-1]
+        score = score + self.end_transitions
+        return self._backtrace(score, history, mask)